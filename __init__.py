@@ -16,6 +16,9 @@ def _json_default_trans(obj):
         return obj.strftime('%Y-%m-%d')
     if isinstance(obj, decimal.Decimal):
         return str(obj)
+    if hasattr(obj, 'todict'):
+        # dbpool.DBResult/DBRow
+        return obj.todict()
     raise TypeError('%r is not JSON serializable' % obj)
 
 
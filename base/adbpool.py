@@ -0,0 +1,219 @@
+# coding: utf-8
+'''dbpool的asyncio接口，数据库操作在有界线程池中执行，连接池、指标和读写分离与同步接口相同
+
+    adb = AsyncDBPool()
+    async with adb.acquire('test') as db:
+        rows = await db.query('select * from t where id=%s', (1,))
+        await db.insert('t', {'name':'a'})
+
+    rows = await adb.query('test', 'select * from t')
+
+    async for row in adb.query_iter('test', 'select * from t'):
+        ...
+
+    async with adb.transaction('test') as tx:
+        await tx.update('t', {'name':'b'}, {'id':1})
+
+sqlite需要配置check_same_thread=False，并且不能使用thread_conn
+'''
+import asyncio
+import functools
+import inspect
+import logging
+import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from mtools.base import dbpool
+
+log = logging.getLogger()
+
+_MISSING = object()
+
+def _call(obj, name, args, kw):
+    return getattr(obj, name)(*args, **kw)
+
+
+class AsyncConnection:
+    '''连接的异步代理: 方法在线程池中执行，返回协程'''
+    def __init__(self, adb, conn):
+        self._adb = adb
+        self._conn = conn
+
+    def __getattr__(self, name):
+        # 读写分离的连接(DBConnProxy)取方法时才获取主库或从库的连接，可能阻塞，
+        # 所以不在事件循环中取，只静态查找普通属性
+        attr = inspect.getattr_static(self._conn, name, _MISSING)
+        if attr is not _MISSING and not callable(attr):
+            return getattr(self._conn, name)
+        async def _(*args, **kw):
+            return await self._adb.run(_call, self._conn, name, args, kw)
+        return _
+
+    async def query_iter(self, sql, param=None, isdict=True, batch=1000, as_batch=False):
+        '''异步流式查询，每次在线程池中读取一批'''
+        it = await self._adb.run(_call, self._conn, 'query_iter', (sql, param, isdict, batch, True), {})
+        try:
+            while True:
+                rows = await self._adb.run(next, it, None)
+                if rows is None:
+                    break
+                if as_batch:
+                    yield rows
+                else:
+                    for row in rows:
+                        yield row
+        finally:
+            await self._adb.run(it.close)
+
+
+class AsyncDBPool:
+    def __init__(self, max_workers=32, timeout=10):
+        '''max_workers - 执行数据库操作的线程数
+        timeout - 获取连接的超时时间(秒)
+        '''
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='dbpool-async')
+        self.timeout = timeout
+        # 事件循环 => {连接池名: 信号量}，不超过连接池大小地获取连接，避免线程都阻塞在等待连接上。
+        # 信号量绑定创建时的事件循环，每个事件循环单独创建，循环关闭后随之释放
+        self._sems = weakref.WeakKeyDictionary()
+
+    async def run(self, func, *args, **kw):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kw))
+
+    def _pool_key(self, pool):
+        return pool.master.key if isinstance(pool, dbpool.RWDBPool) else pool.key
+
+    def _sem(self, name):
+        loop = asyncio.get_running_loop()
+        sems = self._sems.get(loop)
+        if sems is None:
+            sems = self._sems[loop] = {}
+        sem = sems.get(name)
+        if sem is None:
+            pool = dbpool.dbpool[name]
+            if isinstance(pool, dbpool.RWDBPool):
+                # 一个读写分离的连接最多占用一个主库连接和一个从库连接，
+                # 取主库和所有从库连接数中小的一个，读写都不会超过连接池大小
+                size = pool.master.max_conn
+                if pool.slaves:
+                    size = min(size, sum([x.max_conn for x in pool.slaves]))
+            else:
+                size = pool.max_conn
+            sem = sems[name] = asyncio.Semaphore(size)
+        return sem
+
+    @asynccontextmanager
+    async def acquire(self, name, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        sem = self._sem(name)
+        try:
+            await asyncio.wait_for(sem.acquire(), timeout)
+        except asyncio.TimeoutError:
+            log.error('func=acquire|name=%s|error=no idle connections', name)
+            dbpool.metrics.incr('acquire_timeout', self._pool_key(dbpool.dbpool[name]))
+            raise RuntimeError('no idle connections')
+
+        conn = None
+        try:
+            loop = asyncio.get_running_loop()
+            fut = loop.run_in_executor(self.executor, dbpool.acquire, name, timeout)
+            try:
+                conn = await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # 取消时连接可能随后才取到，取到后归还
+                def _release(f):
+                    if not f.cancelled() and f.exception() is None:
+                        self.executor.submit(dbpool.release, f.result())
+                fut.add_done_callback(_release)
+                raise
+            yield AsyncConnection(self, conn)
+        finally:
+            try:
+                if conn:
+                    await self.run(dbpool.release, conn)
+            finally:
+                sem.release()
+
+    @asynccontextmanager
+    async def transaction(self, name, timeout=None):
+        '''事务: 正常退出提交，异常回滚。读写分离的库使用主库连接'''
+        async with self.acquire(name, timeout) as conn:
+            c = conn._conn
+            if isinstance(c, dbpool.DBConnProxy):
+                c = await self.run(getattr, c, 'master')
+            tx = AsyncConnection(self, c)
+            await tx.start()
+            try:
+                yield tx
+            except BaseException:
+                try:
+                    await tx.rollback()
+                except Exception:
+                    log.warning(traceback.format_exc())
+                raise
+            await tx.commit()
+
+    async def query_iter(self, name, sql, param=None, isdict=True, batch=1000, as_batch=False, timeout=None):
+        async with self.acquire(name, timeout) as conn:
+            async for x in conn.query_iter(sql, param, isdict, batch, as_batch):
+                yield x
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def _pool_method(method):
+    async def _(self, name, *args, **kw):
+        async with self.acquire(name) as conn:
+            return await getattr(conn, method)(*args, **kw)
+    _.__name__ = method
+    _.__doc__ = '取连接执行%s后归还' % method
+    return _
+
+for _m in ('query', 'get', 'execute', 'executemany', 'select', 'select_one', 'select_join',
+        'insert', 'insert_list', 'update', 'delete'):
+    setattr(AsyncDBPool, _m, _pool_method(_m))
+
+
+def test():
+    import os, tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'test.db')
+    dbpool.install({'test': {'engine':'sqlite', 'db':path, 'conn':4, 'check_same_thread':False}})
+
+    adb = AsyncDBPool(8)
+    async def run():
+        await adb.execute('test', 'create table t(id integer primary key, name text)')
+        await asyncio.gather(*[adb.insert('test', 't', {'name':'n%d' % i}) for i in range(0, 20)])
+
+        async with adb.transaction('test') as tx:
+            await tx.update('t', {'name':'x'}, {'id':1})
+        try:
+            async with adb.transaction('test') as tx:
+                await tx.update('t', {'name':'y'}, {'id':2})
+                raise ValueError('rollback')
+        except ValueError:
+            pass
+
+        n = 0
+        async for row in adb.query_iter('test', 'select * from t', batch=3):
+            n += 1
+        assert n == 20
+        assert (await adb.select_one('test', 't', where={'id':1}))['name'] == 'x'
+        assert (await adb.select_one('test', 't', where={'id':2}))['name'] != 'y'
+
+    # 同一个AsyncDBPool在另一个事件循环中使用，信号量按事件循环创建
+    async def run2():
+        rows = await asyncio.gather(*[adb.select('test', 't', where={'id':i}) for i in range(1, 10)])
+        assert all(rows)
+
+    asyncio.run(run())
+    asyncio.run(run2())
+    adb.close()
+    print('pool:', dbpool.dbpool['test'].stats())
+
+
+if __name__ == '__main__':
+    test()
@@ -4,11 +4,13 @@ import logging
 import traceback
 import csv
 import io
+import functools
 import openpyxl
 import pymysql
 
 from mtools.resp.excepts import ParamError, DevplatException, DBError
-from mtools.base.dbpool import get_connection_exception
+from mtools.base.dbpool import get_connection_exception, run_parallel
+from mtools.base import pager
 
 import config
 
@@ -290,7 +292,7 @@ class ListBuilder(Builder):
                 limit_name = self.w_key(limit_name)
             self.where[limit_name] = limit_value
 
-    def _query_list(self, how='query'):
+    def _other(self, how):
 
         if how == 'query':
             other = self.other
@@ -300,50 +302,121 @@ class ListBuilder(Builder):
             other = self.other_limit
         elif how == 'offset':
             other = self.other_offset
+        return other
+
+    def _select_list(self, db, other):
+        return db.select(
+            table=self.table,
+            fields=self.fields,
+            where=self.where,
+            other=other
+        ) or []
+
+    def _select_count(self, db):
+        if self.count_mode == 'exact':
+            total = db.select(
+                table=self.table,
+                fields='count(*) as total',
+                where=self.where,
+                other=self.group_by
+            ) or []
+            return len(total) if self.group_by else total[0]['total']
+
+        # cache/estimate: 按sql缓存总数，estimate模式行数多时用explain估算
+        sql = db.select_sql(self.table, self.where, 'count(*) as total', self.group_by, placeholder=False)
+        if self.group_by:
+            sql = 'select count(*) as total from ({}) t'.format(sql)
+        total, self.estimated = pager.count_total(db, sql, self.count_mode,
+                self.count_ttl, self.count_estimate)
+        return total
+
+    def _db_error(self, e):
+        '''查询异常转换为返回给调用方的异常'''
+        if isinstance(e, pymysql.ProgrammingError):
+            if e.args[0] == 1146:
+                log.warn('table {} not exist'.format(self.table))
+                return DBError('TABLE_NOT_EXIST')
+            else:
+                return DBError(e.args[1])
+        log.warn(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+        return ParamError('Query data failed')
+
+    def _query_list(self, how='query', other=None):
+
+        if other is None:
+            other = self._other(how)
 
         lists = []
         try:
             with get_connection_exception(self.db) as db:
-                lists = db.select(
-                    table=self.table,
-                    fields=self.fields,
-                    where=self.where,
-                    other=other
-                ) or []
-        except pymysql.ProgrammingError as e:
-            if e.args[0] == 1146:
-                log.warn('table {} not exist'.format(self.table))
-                raise DBError('TABLE_NOT_EXIST')
-            else:
-                raise DBError(e.args[1])
-        except:
-            log.warn(traceback.format_exc())
-            raise ParamError('Query data failed')
+                lists = self._select_list(db, other)
+        except Exception as e:
+            raise self._db_error(e)
         self.lists = lists
         return self.lists
 
     def _query_count(self):
-        total = []
         try:
             with get_connection_exception(self.db) as db:
-                total = db.select(
-                    table=self.table,
-                    fields='count(*) as total',
-                    where=self.where,
-                    other=self.group_by
-                ) or []
-        except pymysql.ProgrammingError as e:
-            if e.args[0] == 1146:
-                log.warn('table {} not exist'.format(self.table))
-                raise DBError('TABLE_NOT_EXIST')
-            else:
-                raise DBError(e.args[1])
-        except:
-            log.warn(traceback.format_exc())
-            raise ParamError('Query data failed')
-        self.total = len(total) if self.group_by else total[0]['total']
+                self.total = self._select_count(db)
+        except Exception as e:
+            raise self._db_error(e)
         return self.total
 
+    def _query_list_count(self, how='query'):
+        '''列表和总数使用两个连接并发查询'''
+
+        other = self._other(how)
+        lists, total = run_parallel([
+            (self.db, functools.partial(self._select_list, other=other)),
+            (self.db, self._select_count),
+        ])
+        for x in (lists, total):
+            if isinstance(x, Exception):
+                raise self._db_error(x)
+        self.lists = lists
+        self.total = total
+        return self.lists, self.total
+
+    def _query_cursor(self):
+        '''游标分页: 从上一页最后一行的排序字段值往后取，不使用offset'''
+
+        order_by = self.limits.get('order_by') or 'id'
+        order = pager.parse_order('{} {}'.format(order_by, self.limits.get('sort') or ''))
+        if not self.group_by:
+            # 排序不唯一时加上id
+            order = pager.unique_order(order)
+        # 游标由最后一行的排序字段值生成，查询的字段中要有排序字段
+        fields = self.fields
+        items = [x.strip() for x in (fields if isinstance(fields, (list, tuple)) else fields.split(','))]
+        names = [x.split()[-1].split('.')[-1].strip('`') for x in items if x]
+        if '*' not in names:
+            lack = [f for f,desc in order if f.split('.')[-1].strip('`') not in names]
+            if lack:
+                fields = items + lack
+        try:
+            values = pager.decode_cursor(self._cursor, len(order))
+        except ValueError:
+            raise ParamError('cursor error')
+
+        try:
+            with get_connection_exception(self.db) as db:
+                sql = db.select_sql(self.table, self.where, fields, placeholder=False)
+                if values:
+                    sql = pager.add_where(sql, pager.seek_sql(db, order, values))
+                sql = '{} {} {} limit {}'.format(sql, self.group_by, pager.order_sql(order), self._size + 1)
+                lists = list(db.query(sql) or [])
+        except ParamError:
+            raise
+        except Exception as e:
+            raise self._db_error(e)
+
+        has_more = len(lists) > self._size
+        lists = lists[:self._size]
+        cursor = pager.row_cursor(lists[-1], order) if has_more else None
+        self.lists = lists
+        return lists, cursor, has_more
+
     def _handle_page(self, data):
         '''处理 分页'''
 
@@ -363,6 +436,13 @@ class ListBuilder(Builder):
         else:
             self._size = 10
 
+        if '_cursor' in data:
+            self._cursor = data['_cursor']
+        elif 'cursor' in data:
+            self._cursor = data['cursor']
+        else:
+            self._cursor = None
+
         if '_offset' in data:
             self._offset = data['_offset']
         elif 'offset' in data:
@@ -380,6 +460,11 @@ class ListBuilder(Builder):
         self.fields = list_args.get('fields') or '*'
         self.rules = list_args.get('rules') or []
         self.limits = list_args.get('limits') or {}
+        # 总数统计方式: exact/cache/estimate/has_more
+        self.count_mode = list_args.get('count') or 'exact'
+        self.count_ttl = list_args.get('count_ttl', 60)
+        self.count_estimate = list_args.get('count_estimate', 100000)
+        self.estimated = False
 
         data = self._handle_page(data)
 
@@ -394,10 +479,21 @@ class ListBuilder(Builder):
         page_no_name = getattr(config, 'PAGE_NO_NAME', 'page_no')
         page_size_name = getattr(config, 'PAGE_SIZE_NAME', 'page_size')
 
-        if how == 'query':
+        if how == 'query' and self.count_mode == 'has_more':
+            # 不统计总数，多取一行判断是否有下一页
+            lists = self._query_list(how, '{} limit {} offset {}'.format(
+                self.other_total, self._size + 1, self.offset))
             self.ret = {
-                page_data_name: self._query_list(how),
-                page_total_count_name: self._query_count(),
+                page_data_name: lists[:self._size],
+                getattr(config, 'PAGE_HAS_MORE_NAME', 'has_more'): len(lists) > self._size,
+                page_no_name: self._page + 1,
+                page_size_name: self._size
+            }
+        elif how == 'query':
+            lists, total = self._query_list_count(how)
+            self.ret = {
+                page_data_name: lists,
+                page_total_count_name: total,
                 page_no_name: self._page + 1,
                 page_size_name: self._size
             }
@@ -408,12 +504,23 @@ class ListBuilder(Builder):
         elif how == 'part':
             self.ret = self._query_list(how)
         elif how == 'offset':
+            lists, total = self._query_list_count(how)
             self.ret = {
-                page_data_name: self._query_list(how),
-                page_total_count_name: self._query_count(),
+                page_data_name: lists,
+                page_total_count_name: total,
+            }
+        elif how == 'cursor':
+            lists, cursor, has_more = self._query_cursor()
+            self.ret = {
+                page_data_name: lists,
+                getattr(config, 'PAGE_CURSOR_NAME', 'cursor'): cursor,
+                getattr(config, 'PAGE_HAS_MORE_NAME', 'has_more'): has_more,
+                page_size_name: self._size
             }
         else:
             raise ParamError('how: {}, is not allowed'.format(how))
+        if self.estimated:
+            self.ret[getattr(config, 'PAGE_ESTIMATED_NAME', 'estimated')] = True
         return self.ret
 
 class ExpoBuilder(Builder):
@@ -6,6 +6,12 @@ import logging
 import copy
 import re
 import traceback
+import bisect
+import sys
+import queue
+import collections
+import collections.abc
+import functools
 from mtools.base import pager
 from contextlib import contextmanager
 log = logging.getLogger()
@@ -17,9 +23,29 @@ settings = {
     'format_time': False,
     # 日志级别 all/simple
     'log_level': 'all',
+    # 后台维护线程的执行间隔(秒)，0表示不启动
+    'maintain_interval': 5,
+    # sql模板缓存的条数，0表示不缓存
+    'sql_cache_size': 1024,
+    # query(isdict=True)返回列式的DBResult，行数据按需转换为字典
+    'lazy_result': False,
+    # 查询结果缓存的最大字节数(估算)，需要在连接配置中用cache_tables开启
+    'result_cache_bytes': 64*1024*1024,
+    # 是否收集连接池和sql指标
+    'metrics': True,
+    # run_parallel使用的线程池大小
+    'parallel_workers': 16,
+    # 慢查询阈值(微秒)，0表示不记录
+    'slow_time': 500000,
+    # 保留最近的慢查询条数
+    'slow_log_size': 1000,
+    # 新出现的慢查询指纹是否用单独的连接执行explain
+    'slow_explain': True,
 }
 
 KEY_CP = re.compile('["\'\-\\\*\#,;\/\=\<\>` ]+')
+# 占位符模式下生成sql时使用的内部占位符，最后统一替换为驱动的占位符
+PARAM_MARK = '\0'
 
 def timeit(func):
     def _(*args, **kwargs):
@@ -29,7 +55,7 @@ def timeit(func):
         err = ''
         try:
             retval = func(*args, **kwargs)
-            if isinstance(retval, list):
+            if isinstance(retval, (list, DBResult)):
                 num = len(retval)
             elif isinstance(retval, dict):
                 num = 1
@@ -43,6 +69,19 @@ def timeit(func):
         finally:
             endtm = time.time()
             conn = args[0]
+            if conn.pool:
+                conn.pool.record_latency((endtm-starttm)*1000000)
+                if settings.get('metrics', True) and isinstance(args[1], str):
+                    metrics.observe('query', conn.pool.key, int((endtm-starttm)*1000000),
+                            sql_fingerprint(args[1]))
+            usec = int((endtm-starttm)*1000000)
+            slow_time = settings.get('slow_time', 0)
+            if slow_time and usec >= slow_time and isinstance(args[1], str):
+                try:
+                    slow_log.record(conn, args[1],
+                            args[2] if len(args) > 2 else kwargs.get('param'), usec, err)
+                except:
+                    log.warning(traceback.format_exc())
             #dbcf = conn.pool.dbcf
             dbcf = conn.param
             sql = repr(args[1])
@@ -62,6 +101,25 @@ def timeit(func):
     return _
 
 
+class BulkInsertError (Exception):
+    '''批量插入中某一批失败
+    cause - 原始异常
+    chunk - 失败的批次序号，offset/rows - 该批次的起始行和行数
+    affected - 失败前已写入的行数
+    '''
+    def __init__(self, cause, chunk, offset, rows, affected):
+        Exception.__init__(self, cause, chunk, offset, rows, affected)
+        self.cause = cause
+        self.chunk = chunk
+        self.offset = offset
+        self.rows = rows
+        self.affected = affected
+
+    def __str__(self):
+        return 'BulkInsertError(chunk=%d, offset=%d, rows=%d, affected=%d, error=%s)' % (
+                self.chunk, self.offset, self.rows, self.affected, self.cause)
+
+
 class DBPoolBase:
     def acquire(self, name):
         pass
@@ -70,28 +128,110 @@ class DBPoolBase:
         pass
 
 
+class DBRow (collections.abc.MutableMapping):
+    '''DBResult中一行数据的视图，按字典方式访问，修改时才转换为字典'''
+    __slots__ = ('_res', '_i')
+
+    def __init__(self, res, i):
+        self._res = res
+        self._i = i
+
+    def __getitem__(self, key):
+        row = self._res.data[self._i]
+        if isinstance(row, dict):
+            return row[key]
+        return row[self._res.index[key]]
+
+    def __setitem__(self, key, value):
+        self._res.materialize(self._i)[key] = value
+
+    def __delitem__(self, key):
+        del self._res.materialize(self._i)[key]
+
+    def __iter__(self):
+        row = self._res.data[self._i]
+        if isinstance(row, dict):
+            return iter(row)
+        return iter(self._res.fields)
+
+    def __len__(self):
+        row = self._res.data[self._i]
+        if isinstance(row, dict):
+            return len(row)
+        return len(self._res.fields)
+
+    def __contains__(self, key):
+        row = self._res.data[self._i]
+        if isinstance(row, dict):
+            return key in row
+        return key in self._res.index
+
+    def todict(self):
+        row = self._res.data[self._i]
+        if isinstance(row, dict):
+            return dict(row)
+        return dict(zip(self._res.fields, row))
+
+    copy = todict
+
+    def __repr__(self):
+        return repr(self.todict())
+
+
 class DBResult:
+    '''列式查询结果: 字段索引共享，行数据为元组，按需生成字典'''
     def __init__(self, fields, data):
         self.fields = fields
+        self.index = dict([(k, i) for i,k in enumerate(fields)])
         self.data = data
 
+    def materialize(self, i):
+        '''把第i行转换为字典，返回该字典'''
+        row = self.data[i]
+        if not isinstance(row, dict):
+            row = dict(zip(self.fields, row))
+            self.data[i] = row
+        return row
+
     def todict(self):
         ret = []
         for item in self.data:
-            ret.append(dict(zip(self.fields, item)))
+            if isinstance(item, dict):
+                ret.append(dict(item))
+            else:
+                ret.append(dict(zip(self.fields, item)))
         return ret
 
+    to_dicts = todict
+
+    def column(self, name):
+        '''返回一列数据'''
+        idx = self.index[name]
+        return [row[name] if isinstance(row, dict) else row[idx] for row in self.data]
+
+    def __len__(self):
+        return len(self.data)
+
     def __iter__(self):
-        for row in self.data:
-            yield dict(zip(self.fields, row))
+        for i in range(0, len(self.data)):
+            yield DBRow(self, i)
 
     def row(self, i, isdict=True):
         if isdict:
-            return dict(zip(self.fields, self.data[i]))
+            return DBRow(self, i).todict()
         return self.data[i]
 
     def __getitem__(self, i):
-        return dict(zip(self.fields, self.data[i]))
+        if isinstance(i, slice):
+            return [DBRow(self, x) for x in range(*i.indices(len(self.data)))]
+        if i < 0:
+            i += len(self.data)
+        if i < 0 or i >= len(self.data):
+            raise IndexError('DBResult index out of range')
+        return DBRow(self, i)
+
+    def __repr__(self):
+        return repr(self.todict())
 
 
 class DBFunc(object):
@@ -103,18 +243,547 @@ class DBFunc(object):
         return 'DBFunc({})'.format(self.value)
 
 
+class SQLTemplateCache:
+    '''按查询形状缓存编译好的sql模板，LRU淘汰
+    maxsize为None时每次使用settings['sql_cache_size']，运行中修改配置也生效，0为不缓存
+    '''
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        if self._maxsize is not None:
+            return self._maxsize
+        return settings.get('sql_cache_size', 1024)
+
+    def get(self, key):
+        if not self.maxsize:
+            self.misses += 1
+            return None
+        with self._lock:
+            tpl = self._data.get(key)
+            if tpl is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return tpl
+
+    def put(self, key, tpl):
+        maxsize = self.maxsize
+        if not maxsize:
+            return
+        with self._lock:
+            self._data[key] = tpl
+            # 配置改小后逐步淘汰到新的大小
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stat(self):
+        total = self.hits + self.misses
+        return {'size':len(self._data), 'maxsize':self.maxsize,
+                'hits':self.hits, 'misses':self.misses,
+                'ratio':float(self.hits)/total if total else 0}
+
+sql_cache = SQLTemplateCache()
+
+
+class ResultCache:
+    '''查询结果缓存，按表打标签，本进程内对表的写操作会使该表的缓存失效
+    同时有ttl过期，总大小按估算的字节数限制，LRU淘汰
+    max_bytes为None时每次使用settings['result_cache_bytes']，运行中修改配置也生效，0为不缓存
+    有未提交的写事务的表不放入缓存，查询期间表有写操作时查询结果也不放入
+    '''
+    def __init__(self, max_bytes=None, max_rows=1000):
+        self._max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.nbytes = 0
+        # 放入过缓存后写操作才需要使失效
+        self.active = False
+        # key => (过期时间, 标签, 结果, 大小)
+        self._data = collections.OrderedDict()
+        # (库名, 表名) => set(key)
+        self.tags = {}
+        # (库名, 表名) => 未结束的写事务数
+        self.pending = {}
+        # (库名, 表名) => 失效次数，查询前后不同说明期间有写操作
+        self.versions = {}
+        # 表名 => {'hit':0, 'miss':0, 'invalidate':0}
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return settings.get('result_cache_bytes', 64*1024*1024)
+
+    def _table_stat(self, table):
+        st = self.tables.get(table)
+        if st is None:
+            st = self.tables[table] = {'hit':0, 'miss':0, 'invalidate':0}
+        return st
+
+    def get(self, key, tables):
+        with self._lock:
+            item = self._data.get(key)
+            if item and item[0] < time.time():
+                self._remove(key)
+                item = None
+            stat = 'hit' if item else 'miss'
+            for t in tables:
+                self._table_stat(t)[stat] += 1
+            if not item:
+                return False, None
+            self._data.move_to_end(key)
+        return True, _copy_result(item[2])
+
+    def version(self, name, tables):
+        '''查询前取表的版本，放入缓存时检查'''
+        return tuple([self.versions.get((name, t), 0) for t in tables])
+
+    def put(self, key, name, tables, value, ttl, version=None):
+        max_bytes = self.max_bytes
+        if not max_bytes:
+            return
+        if isinstance(value, (list, DBResult)) and len(value) > self.max_rows:
+            return
+        size = _result_size(value)
+        if size > max_bytes:
+            return
+        tags = [(name, t) for t in tables]
+        with self._lock:
+            for tag in tags:
+                if tag in self.pending:
+                    return
+            if version is not None and version != self.version(name, tables):
+                return
+            self.active = True
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.time() + ttl, tags, _copy_result(value), size)
+            self.nbytes += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.nbytes > max_bytes and self._data:
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if not item:
+            return
+        self.nbytes -= item[3]
+        for tag in item[1]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    self.tags.pop(tag, None)
+
+    def invalidate(self, name, tables):
+        '''表有写操作，删除该表相关的缓存'''
+        with self._lock:
+            for t in tables:
+                self.versions[(name, t)] = self.versions.get((name, t), 0) + 1
+                keys = self.tags.get((name, t))
+                if not keys:
+                    continue
+                self._table_stat(t)['invalidate'] += 1
+                for key in list(keys):
+                    self._remove(key)
+
+    def begin(self, name, tables):
+        '''事务中写了这些表，提交或回滚前不缓存'''
+        with self._lock:
+            for t in tables:
+                self.pending[(name, t)] = self.pending.get((name, t), 0) + 1
+
+    def end(self, name, tables):
+        '''事务结束，再次使缓存失效'''
+        with self._lock:
+            for t in tables:
+                n = self.pending.pop((name, t), 0) - 1
+                if n > 0:
+                    self.pending[(name, t)] = n
+        self.invalidate(name, tables)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.tags = {}
+            self.nbytes = 0
+
+    def stat(self):
+        return {'size':len(self._data), 'bytes':self.nbytes, 'max_bytes':self.max_bytes,
+                'tables':copy.deepcopy(self.tables)}
+
+result_cache = ResultCache()
+
+
+def affected_rows(ret):
+    '''execute的返回值转为影响的行数: 驱动返回行数或游标'''
+    if isinstance(ret, int):
+        return ret
+    return max(getattr(ret, 'rowcount', 0) or 0, 0)
+
+
+def _copy_result(v):
+    '''复制查询结果，调用方修改返回值不影响缓存'''
+    if isinstance(v, DBResult):
+        return DBResult(v.fields, [dict(r) if isinstance(r, dict) else r for r in v.data])
+    if isinstance(v, list):
+        return [_copy_result(r) for r in v]
+    if isinstance(v, dict):
+        return dict(v)
+    return v
+
+
+def _result_size(v):
+    '''估算查询结果占用的字节数'''
+    if isinstance(v, DBResult):
+        v = v.data
+    if isinstance(v, dict):
+        return 64 + sum([_result_size(x) for x in v.values()])
+    if isinstance(v, (list, tuple)):
+        return 64 + sum([_result_size(x) for x in v])
+    if isinstance(v, (str, bytes)):
+        return 48 + len(v)
+    return 24
+
+
+# 耗时直方图的桶上限(微秒)
+TIME_BUCKETS = (100, 500, 1000, 5000, 10000, 50000, 100000, 500000, 1000000, 5000000)
+# 连接数直方图的桶上限
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class Histogram:
+    '''固定分桶的直方图'''
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, v):
+        i = bisect.bisect_left(self.bounds, v)
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, p):
+        '''按桶估算百分位数，返回所在桶的上限'''
+        if not self.count:
+            return 0
+        n = self.count * p / 100.0
+        for i,c in enumerate(self.buckets):
+            n -= c
+            if n <= 0:
+                break
+        if i < len(self.bounds):
+            return min(self.bounds[i], self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count':self.count, 'sum':self.sum, 'max':self.max,
+                'avg':self.sum/self.count if self.count else 0,
+                'p50':self.percentile(50), 'p90':self.percentile(90), 'p99':self.percentile(99),
+                'bounds':list(self.bounds), 'buckets':list(self.buckets)}
+
+
+class Metrics:
+    '''进程内的连接池指标: 计数器和直方图，按指标名、连接池、标签区分'''
+    def __init__(self, max_labels=1000):
+        self.max_labels = max_labels
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, pool, n=1):
+        if not settings.get('metrics', True):
+            return
+        key = (name, pool)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, pool, value, label='', bounds=TIME_BUCKETS):
+        if not settings.get('metrics', True):
+            return
+        key = (name, pool, label)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                if label and len(self.histograms) >= self.max_labels:
+                    key = (name, pool, '__other__')
+                    h = self.histograms.get(key)
+                if h is None:
+                    h = self.histograms[key] = Histogram(bounds)
+            h.observe(value)
+
+    def counter(self, name, pool):
+        return self.counters.get((name, pool), 0)
+
+    def histogram(self, name, pool, label=''):
+        return self.histograms.get((name, pool, label))
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        '''返回可以json序列化的指标快照'''
+        ret = {'counter':{}, 'histogram':{}}
+        with self._lock:
+            for (name, pool),v in self.counters.items():
+                ret['counter'].setdefault(name, {})[pool] = v
+            for (name, pool, label),h in self.histograms.items():
+                ret['histogram'].setdefault(name, {}).setdefault(pool, {})[label] = h.snapshot()
+        return ret
+
+metrics = Metrics()
+
+
+FP_STR_CP = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+FP_NUM_CP = re.compile(r'\b\d+(?:\.\d+)?\b')
+FP_LIST_CP = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+FP_ROWS_CP = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+
+@functools.lru_cache(maxsize=4096)
+def sql_fingerprint(sql):
+    '''sql指纹: 去掉字面值和多余空白，in列表合并为一个'''
+    fp = FP_STR_CP.sub('?', sql)
+    fp = FP_NUM_CP.sub('?', fp)
+    fp = fp.replace('%s', '?')
+    fp = FP_LIST_CP.sub('(?+)', fp)
+    fp = FP_ROWS_CP.sub('(?+)+', fp)
+    return ' '.join(fp.split()).lower()
+
+
+def _params_shape(param):
+    '''参数的形状: 类型名，不包括具体的值'''
+    if param is None:
+        return None
+    if isinstance(param, dict):
+        return dict([(k, type(v).__name__) for k,v in param.items()])
+    if isinstance(param, (tuple, list)):
+        if param and isinstance(param[0], (tuple, list, dict)):
+            # executemany的多行参数
+            return '%d*%s' % (len(param), _params_shape(param[0]))
+        ret = [type(v).__name__ for v in param[:20]]
+        if len(param) > 20:
+            ret.append('...%d' % len(param))
+        return ret
+    return type(param).__name__
+
+# 查找调用位置时跳过的文件
+CALLER_SKIP = ('dbpool.py', 'dbsharding.py', 'pager.py', 'contextlib.py')
+
+def _caller():
+    f = sys._getframe(2)
+    while f and f.f_code.co_filename.endswith(CALLER_SKIP):
+        f = f.f_back
+    if not f:
+        return ''
+    return '%s:%d:%s' % (f.f_code.co_filename, f.f_lineno, f.f_code.co_name)
+
+
+class SlowQueryLog:
+    '''最近的慢查询，新的慢查询指纹在后台用单独的连接执行explain'''
+    def __init__(self, size=1000, max_explain=1000):
+        self.items = collections.deque(maxlen=size)
+        # 指纹 => explain结果，None表示还没有结果
+        self.explains = collections.OrderedDict()
+        self.max_explain = max_explain
+        self.stat = {'slow':0, 'explain':0, 'explain_fail':0, 'explain_drop':0}
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = 0
+
+    def record(self, conn, sql, param, usec, err=''):
+        size = settings.get('slow_log_size', 1000)
+        fp = sql_fingerprint(sql)
+        item = {
+            'time': int(time.time()),
+            'fingerprint': fp,
+            'sql': sql[:1024],
+            'params': _params_shape(param),
+            'usec': usec,
+            'pool': conn.pool.key if conn.pool else conn.name,
+            'name': conn.name,
+            'caller': _caller(),
+            'err': str(err),
+        }
+        log.warning('func=slow_query|name=%s|time=%d|caller=%s|sql=%s', conn.name, usec,
+                item['caller'], fp)
+        with self._lock:
+            if self.items.maxlen != size:
+                self.items = collections.deque(self.items, maxlen=size)
+            self.items.append(item)
+            self.stat['slow'] += 1
+            newfp = fp not in self.explains
+            if newfp:
+                self.explains[fp] = None
+                while len(self.explains) > self.max_explain:
+                    self.explains.popitem(last=False)
+        if newfp and settings.get('slow_explain', True) and conn.pool and \
+                fp.startswith('select') and not isinstance(param, list):
+            self._explain(conn.pool, sql, param, fp)
+
+    def _explain(self, pool, sql, param, fp):
+        with self._lock:
+            if self._pid != os.getpid():
+                # 第一次使用或fork后的子进程启动线程，多个线程同时记录时只启动一个
+                self._pid = os.getpid()
+                self._queue = queue.Queue(100)
+                th = threading.Thread(target=self._run, args=(self._queue,), name='dbpool-explain')
+                th.daemon = True
+                th.start()
+            q = self._queue
+        try:
+            q.put_nowait((pool, sql, param, fp))
+        except queue.Full:
+            self.stat['explain_drop'] += 1
+
+    def _run(self, q):
+        while True:
+            pool, sql, param, fp = q.get()
+            try:
+                plan = self.explain(pool, sql, param)
+                self.stat['explain'] += 1
+            except Exception as e:
+                log.warning('func=explain|sql=%s|error=%s', fp, traceback.format_exc())
+                plan = {'error': str(e)}
+                self.stat['explain_fail'] += 1
+            with self._lock:
+                if fp in self.explains:
+                    self.explains[fp] = {'time':int(time.time()), 'sql':sql[:1024], 'plan':plan}
+
+    def explain(self, pool, sql, param=None):
+        '''用连接池中的另一个连接执行explain，不经过timeit以免再次记录'''
+        conn = pool.acquire(1)
+        try:
+            cur = conn.conn.cursor()
+            try:
+                if param:
+                    cur.execute(conn.explain_prefix + sql, param)
+                else:
+                    cur.execute(conn.explain_prefix + sql)
+                fields = [x[0] for x in cur.description or []]
+                return [dict(zip(fields, row)) for row in cur.fetchall()]
+            finally:
+                cur.close()
+        finally:
+            pool.release(conn)
+
+    def get(self, n=None, name=None):
+        '''最近的慢查询，最新的在前'''
+        with self._lock:
+            items = [dict(x) for x in self.items]
+        items.reverse()
+        if name:
+            items = [x for x in items if x['name'] == name]
+        for x in items:
+            x['explain'] = self.explains.get(x['fingerprint'])
+        return items[:n] if n else items
+
+    def top(self, n=20):
+        '''按指纹汇总，按总耗时倒序'''
+        ret = {}
+        with self._lock:
+            items = list(self.items)
+        for x in items:
+            v = ret.setdefault(x['fingerprint'], {'fingerprint':x['fingerprint'],
+                'count':0, 'usec':0, 'max':0, 'caller':x['caller']})
+            v['count'] += 1
+            v['usec'] += x['usec']
+            v['max'] = max(v['max'], x['usec'])
+        return sorted(ret.values(), key=lambda x: -x['usec'])[:n]
+
+    def clear(self):
+        with self._lock:
+            self.items.clear()
+            self.explains.clear()
+
+slow_log = SlowQueryLog(settings.get('slow_log_size', 1000))
+
+
+def _norm_where(d):
+    '''in/not in/between的值为set、range、生成器等时转为tuple，sql模板按值的个数区分'''
+    if not d:
+        return d
+    ret = d
+    for k,v in d.items():
+        if (isinstance(v, (tuple,list)) and len(v) > 1 and v[0] in ('in', 'not in', 'between')
+                and not isinstance(v[1], (tuple,list))):
+            if ret is d:
+                ret = dict(d)
+            ret[k] = (v[0], tuple(v[1]))
+    return ret
+
+def _value_shape(v):
+    if isinstance(v, (tuple,list)):
+        return tuple([_value_shape(x) for x in v])
+    if isinstance(v, DBFunc):
+        return ('DBFunc', v.value)
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_table(table):
+    #如果有as
+    table = table.strip(' `').replace(',','`,`')
+    index = table.find(' ')
+    if ' ' in table:
+        return '`%s`%s' % ( table[:index] ,table[index:])
+    else:
+        return '`%s`' % table
+
+
+class TimestampDatetime (datetime.datetime):
+    '''format_time由整数时间戳转换成的datetime，游标分页用int(timestamp())取回原值'''
+    from_timestamp = True
+
+
 class DBConnection:
+    # 驱动的参数占位符
+    param_mark = '%s'
+    # 查看执行计划的语句前缀
+    explain_prefix = 'explain '
+
     def __init__(self, param, lasttime, status):
         self.name       = param.get('name')
         self.param      = param
         self.conn       = None
         self.status     = status
         self.lasttime   = lasttime
+        self.pingtime   = lasttime
         self.pool       = None
         self.server_id  = None
         self.conn_id    = 0
         self.trans      = 0 # is start transaction
+        self._savepoint = 0 # 嵌套事务的savepoint层数
+        self._trans_tables = set() # 事务中写过的表
+        self.writes     = 0 # 本次使用(acquire到release)中的写操作次数
         self.role       = param.get('role', 'm') # master/slave
+        # 占位符模式: *_sql 返回(sql, params)，值由驱动绑定
+        self.placeholder = param.get('placeholder', False)
+        # 正在进行的流式查询
+        self._stream    = None
+        # query返回DBResult
+        self.lazy_result = param.get('lazy_result', settings.get('lazy_result', False))
 
     def __str__(self):
         return '<%s %s:%d %s@%s>' % (self.type,
@@ -136,7 +805,7 @@ class DBConnection:
         pass
 
     def close(self):
-        pass
+        self._trans_reset()
 
     def alive(self):
         pass
@@ -144,26 +813,80 @@ class DBConnection:
     def cursor(self):
         return self.conn.cursor()
 
+    def ss_cursor(self):
+        '''服务端(不缓存结果集)游标，默认为普通游标'''
+        return self.conn.cursor()
+
     def fields(self):
         pass
 
     @timeit
     def execute(self, sql, param=None):
         #log.info('exec:%s', sql)
-        cur = self.conn.cursor()
-        if param:
-            ret = cur.execute(sql, param)
-        else:
-            ret = cur.execute(sql)
-        cur.close()
-        return ret
+        try:
+            cur = self.conn.cursor()
+            if param:
+                ret = cur.execute(sql, param)
+            else:
+                ret = cur.execute(sql)
+            cur.close()
+            return ret
+        finally:
+            self._on_write('execute', sql)
 
     @timeit
     def executemany(self, sql, param=None):
-        cur = self.conn.cursor()
-        ret = cur.executemany(sql, param)
-        cur.close()
-        return ret
+        try:
+            cur = self.conn.cursor()
+            ret = cur.executemany(sql, param)
+            cur.close()
+            return ret
+        finally:
+            self._on_write('executemany', sql)
+
+    def _rw_pool(self):
+        '''主库连接需要按表记录写入时间时，返回所属的读写分离连接池'''
+        rw = self.pool.rw if self.pool else None
+        if rw is not None and rw.track_write and self.role == 'm':
+            return rw
+        return None
+
+    def _on_write(self, func, sql):
+        '''写操作后: 使表的查询缓存失效，按表的读写一致性记录写入时间。
+        事务中写的表在提交或回滚时再处理一次，期间不缓存
+        '''
+        self.writes += 1
+        rw = self._rw_pool()
+        if not self.trans and not result_cache.active and rw is None:
+            return
+        tables = call_tables(func, (sql,), {})
+        if not tables:
+            return
+        if self.trans:
+            new = [t for t in tables if t not in self._trans_tables]
+            if new:
+                self._trans_tables.update(new)
+                result_cache.begin(self.name, new)
+        result_cache.invalidate(self.name, tables)
+        if rw is not None:
+            rw.mark_write(tables)
+
+    def _trans_done(self):
+        '''事务提交或回滚后调用，从库在提交之后才同步到数据，一致性窗口从这时开始'''
+        if self._trans_tables:
+            tables, self._trans_tables = list(self._trans_tables), set()
+            result_cache.end(self.name, tables)
+            rw = self._rw_pool()
+            if rw is not None:
+                rw.mark_write(tables)
+
+    def _trans_reset(self):
+        '''连接关闭或重连后未提交的事务已丢失，清掉事务状态和结果缓存中pending的表'''
+        self.trans = 0
+        self._savepoint = 0
+        if self._trans_tables:
+            tables, self._trans_tables = list(self._trans_tables), set()
+            result_cache.end(self.name, tables)
 
     @timeit
     def query(self, sql, param=None, isdict=True, head=False):
@@ -176,8 +899,14 @@ class DBConnection:
             cur.execute(sql)
         res = cur.fetchall()
         cur.close()
-        res = [self.format_timestamp(r, cur) for r in res]
+        conv = self.row_converter(cur)
+        if conv:
+            res = [conv(r) for r in res]
+        else:
+            res = list(res)
         #log.info('desc:', cur.description)
+        if isdict and self.lazy_result and cur.description:
+            return DBResult([ i[0] for i in cur.description], res)
         if res and isdict:
             ret = []
             xkeys = [ i[0] for i in cur.description]
@@ -191,6 +920,64 @@ class DBConnection:
                 ret.insert(0, xkeys)
         return ret
 
+    def query_iter(self, sql, param=None, isdict=True, batch=1000, as_batch=False):
+        '''流式查询，使用服务端游标fetchmany分批读取，返回生成器
+        as_batch为True时每次返回一批数据，否则逐行返回
+        生成器未读完就被关闭或者连接被释放时，会关闭游标
+        '''
+        self.close_stream()
+        it = self._query_iter(sql, param, isdict, batch, as_batch)
+        self._stream = it
+        return it
+
+    def _query_iter(self, sql, param, isdict, batch, as_batch):
+        starttm = time.time()
+        num = 0
+        err = ''
+        cur = self.ss_cursor()
+        try:
+            if param:
+                cur.execute(sql, param)
+            else:
+                cur.execute(sql)
+            xkeys = [ i[0] for i in cur.description]
+            conv = self.row_converter(cur)
+            while True:
+                res = cur.fetchmany(batch)
+                if not res:
+                    break
+                num += len(res)
+                if conv:
+                    res = [conv(r) for r in res]
+                if isdict:
+                    res = [dict(zip(xkeys, item)) for item in res]
+                if as_batch:
+                    yield res
+                else:
+                    for item in res:
+                        yield item
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            err = e
+            raise
+        finally:
+            try:
+                cur.close()
+            except:
+                log.warning(traceback.format_exc())
+            self._stream = None
+            log.info('server=%s|id=%d|name=%s|func=query_iter|time=%d|n=%d|sql=%s|err=%s',
+                     self.type, self.conn_id%10000, self.name,
+                     int((time.time()-starttm)*1000000), num, repr(sql), err)
+
+    def close_stream(self):
+        '''关闭未读完的流式查询'''
+        it = self._stream
+        if it is not None:
+            self._stream = None
+            it.close()
+
     @timeit
     def get(self, sql, param=None, isdict=True):
         '''sql查询，只返回一条'''
@@ -213,10 +1000,15 @@ class DBConnection:
 
         return self.escape(v)
 
-    def value2sql(self, v, charset='utf-8'):
+    def value2sql(self, v, charset='utf-8', params=None):
+        '''params不为None时使用占位符模式，值放入params，返回占位符'''
         if isinstance(v, bytes):
             v = v.decode(charset)
 
+        if params is not None and not isinstance(v, DBFunc):
+            params.append(v)
+            return PARAM_MARK
+
         if isinstance(v, str):
             #if v.startswith(('now()','md5(')):
             #    return v
@@ -233,50 +1025,51 @@ class DBConnection:
     def key2sql(self, v):
         return re.sub(KEY_CP, '', v)
 
-    def exp2sql(self, key, op, value):
+    def exp2sql(self, key, op, value, params=None):
         key = self.key2sql(key)
         item = '(`%s` %s ' % (key.replace('.','`.`'), op)
         if op == 'in':
-            item += '(%s))' % ','.join([self.value2sql(x) for x in value])
+            item += '(%s))' % ','.join([self.value2sql(x, params=params) for x in value])
         elif op == 'not in':
-            item += '(%s))' % ','.join([self.value2sql(x) for x in value])
+            item += '(%s))' % ','.join([self.value2sql(x, params=params) for x in value])
         elif op == 'between':
-            item += ' %s and %s)' % (self.value2sql(value[0]), self.value2sql(value[1]))
+            item += ' %s and %s)' % (self.value2sql(value[0], params=params),
+                    self.value2sql(value[1], params=params))
         elif op in ('is not', 'is'):
-            item += self.value2sql(value) + ')'
+            item += self.value2sql(value, params=params) + ')'
         else:
-            item += self.value2sql(value) + ')'
+            item += self.value2sql(value, params=params) + ')'
         return item
 
-    def dict2sql(self, d, sp=','):
+    def dict2sql(self, d, sp=',', params=None):
         '''字典可以是 {name:value} 形式，也可以是 {name:(operator, value)}'''
         x = []
         for k,v in d.items():
             k = self.key2sql(k)
             if isinstance(v, (tuple,list)):
-                x.append('%s' % self.exp2sql(k, v[0], v[1]))
+                x.append('%s' % self.exp2sql(k, v[0], v[1], params))
             else:
                 x.append('`%s`=%s' % (k.replace('.','`.`'),
-                    self.value2sql(v)))
+                    self.value2sql(v, params=params)))
         return sp.join(x)
 
-    def dict2on(self, d, sp=' and '):
+    def dict2on(self, d, sp=' and ', params=None):
         x = []
         for k,v in d.items():
             k = self.key2sql(k)
             if isinstance(v, (tuple,list)):
-                x.append('%s' % self.exp2sql(k, v[0], v[1]))
+                x.append('%s' % self.exp2sql(k, v[0], v[1], params))
             else:
                 x.append('`%s`=`%s`' % (k.replace('.','`.`'), v.strip(' `').replace('.','`.`')))
         return sp.join(x)
 
-    def dict2insert(self, d):
+    def dict2insert(self, d, params=None):
         keys = list(d.keys())
         keys.sort()
         vals = []
         new_keys = []
         for k in keys:
-            vals.append('%s' % self.value2sql(d[k]))
+            vals.append('%s' % self.value2sql(d[k], params=params))
             k = self.key2sql(k)
             new_keys.append('`' + k + '`')
         #new_keys = ['`' + k.strip('`') + '`' for k in keys]
@@ -293,29 +1086,149 @@ class DBConnection:
 
     def format_table(self, table):
         '''调整table 支持加上 `` 并支持as'''
-        #如果有as
-        table = table.strip(' `').replace(',','`,`')
-        index = table.find(' ')
-        if ' ' in table:
-            return '`%s`%s' % ( table[:index] ,table[index:])
-        else:
-            return '`%s`' % table
-
-    def insert_sql(self, table, values, other=None):
+        return _format_table(table)
+
+    def _use_placeholder(self, placeholder):
+        if placeholder is None:
+            return self.placeholder
+        return placeholder
+
+    def _bind_sql(self, sql, params):
+        '''把内部占位符替换成驱动的占位符，返回(sql, params)'''
+        if not params:
+            return sql, params
+        if self.param_mark == '%s':
+            sql = sql.replace('%', '%%')
+        return sql.replace(PARAM_MARK, self.param_mark), params
+
+    def _split_sql(self, sql):
+        if isinstance(sql, tuple):
+            return sql
+        return sql, None
+
+    def insert_sql(self, table, values, other=None, placeholder=None):
         #sql = "insert into %s set %s" % (table, self.dict2sql(values))
-        keys, vals = self.dict2insert(values)
+        params = [] if self._use_placeholder(placeholder) else None
+        keys, vals = self.dict2insert(values, params)
         sql = "insert into %s(%s) values (%s)" % (self.format_table(table), keys, vals)
         if other:
             sql += ' ' + other
+        if params is not None:
+            return self._bind_sql(sql, params)
         return sql
 
 
     def insert(self, table, values, other=None):
-        sql = self.insert_sql(table, values, other)
-        return self.execute(sql)
+        sql, params = self._split_sql(self.insert_sql(table, values, other))
+        return self.execute(sql, params)
+
 
+    def insert_list(self, table, values_list, other=None, chunk_rows=None, chunk_bytes=None, parallel=1):
+        '''批量插入，按行数和字节数分批执行，返回影响的总行数
+        chunk_rows/chunk_bytes - 每批最多行数/估算的最大字节数，默认取连接配置
+        parallel - 不在事务中时，用连接池中的多个连接并发写入
+        某一批失败时抛出BulkInsertError，包含失败的批次和已写入的行数
+        '''
+        chunks = self._chunk_values(values_list, chunk_rows, chunk_bytes)
+        if len(chunks) <= 1:
+            return self._affected(self._insert_list(table, values_list, other))
+
+        if parallel > 1 and not self.trans and self.pool:
+            return self._insert_chunks_parallel(table, chunks, other, parallel)
+
+        affected = 0
+        for i,(offset, rows) in enumerate(chunks):
+            try:
+                affected += self._affected(self._insert_list(table, rows, other))
+            except Exception as e:
+                raise BulkInsertError(e, i, offset, len(rows), affected) from e
+        return affected
+
+    def _chunk_values(self, values_list, chunk_rows=None, chunk_bytes=None):
+        '''把values_list分为多批，返回[(起始行, 行列表)]'''
+        chunk_rows = chunk_rows or self.param.get('chunk_rows', 1000)
+        chunk_bytes = chunk_bytes or self.param.get('chunk_bytes', 1024*1024)
+        chunks = []
+        start = 0
+        size = 0
+        for i,values in enumerate(values_list):
+            n = 3
+            for v in values.values():
+                n += len(v) if isinstance(v, (str, bytes)) else 8
+                n += 3
+            if i > start and (i - start >= chunk_rows or size + n > chunk_bytes):
+                chunks.append((start, values_list[start:i]))
+                start = i
+                size = 0
+            size += n
+        if start < len(values_list):
+            chunks.append((start, values_list[start:]))
+        return chunks
+
+    def _affected(self, ret):
+        return affected_rows(ret)
+
+    def _insert_chunks_parallel(self, table, chunks, other, parallel):
+        lock = threading.Lock()
+        todo = collections.deque(enumerate(chunks))
+        result = {'affected':0, 'error':None}
+
+        def run(conn):
+            while True:
+                with lock:
+                    if not todo or result['error']:
+                        return
+                    i,(offset, rows) = todo.popleft()
+                try:
+                    n = self._affected(conn._insert_list(table, rows, other))
+                except Exception as e:
+                    with lock:
+                        err = result['error']
+                        if not err or err.chunk > i:
+                            result['error'] = BulkInsertError(e, i, offset, len(rows), 0)
+                    return
+                with lock:
+                    result['affected'] += n
+
+        def run_pooled():
+            # 连接在工作线程中获取，避免跨线程使用连接
+            try:
+                conn = self.pool.acquire(self.param.get('timeout', 10))
+            except:
+                log.warning('func=insert_list|error=acquire parallel conn failed')
+                return
+            try:
+                run(conn)
+            finally:
+                self.pool.release(conn)
+
+        ths = [threading.Thread(target=run_pooled) for i in range(0, min(parallel, len(chunks)) - 1)]
+        for t in ths:
+            t.start()
+        run(self)
+        for t in ths:
+            t.join()
+
+        err = result['error']
+        if err:
+            err.affected = result['affected']
+            raise err from err.cause
+        return result['affected']
+
+    def _insert_list(self, table, values_list, other=None):
+        if self.placeholder and values_list and not any(isinstance(v, DBFunc)
+                for values in values_list for v in values.values()):
+            # 占位符模式下所有行共用一个语句模板，使用executemany
+            params = []
+            keys, vals = self.dict2insert(values_list[0], params)
+            sql = 'insert into %s (%s) values(%s)' % (self.format_table(table), keys, vals)
+            if other:
+                sql += ' ' + other
+            sql, params = self._bind_sql(sql, params)
+            names = sorted(values_list[0].keys())
+            rows = [[values[k] for k in names] for values in values_list]
+            return self.executemany(sql, rows)
 
-    def insert_list(self, table, values_list, other=None):
         sql = 'insert into %s ' % self.format_table(table)
         sql_key = ''
         sql_value = []
@@ -329,34 +1242,43 @@ class DBConnection:
         return self.execute(sql)
 
 
-    def update_sql(self, table, values, where=None, other=None):
-        sql = "update %s set %s" % (self.format_table(table), self.dict2sql(values))
+    def update_sql(self, table, values, where=None, other=None, placeholder=None):
+        params = [] if self._use_placeholder(placeholder) else None
+        sql = "update %s set %s" % (self.format_table(table), self.dict2sql(values, params=params))
         if where:
-            sql += " where %s" % self.dict2sql(where,' and ')
+            sql += " where %s" % self.dict2sql(where,' and ', params)
         if other:
             sql += ' ' + other
+        if params is not None:
+            return self._bind_sql(sql, params)
         return sql
 
 
     def update(self, table, values, where=None, other=None):
-        sql = self.update_sql(table, values, where, other)
-        return self.execute(sql)
+        sql, params = self._split_sql(self.update_sql(table, values, where, other))
+        return self.execute(sql, params)
 
-    def delete_sql(self, table, where, other=None):
+    def delete_sql(self, table, where, other=None, placeholder=None):
+        params = [] if self._use_placeholder(placeholder) else None
         sql = "delete from %s" % self.format_table(table)
         if where:
-            sql += " where %s" % self.dict2sql(where, ' and ')
+            sql += " where %s" % self.dict2sql(where, ' and ', params)
         if other:
             sql += ' ' + other
+        if params is not None:
+            return self._bind_sql(sql, params)
         return sql
 
     def delete(self, table, where, other=None):
-        sql = self.delete_sql(table, where, other)
-        return self.execute(sql)
+        sql, params = self._split_sql(self.delete_sql(table, where, other))
+        return self.execute(sql, params)
 
     def select(self, table, where=None, fields='*', other=None, isdict=True):
-        sql = self.select_sql(table, where, fields, other)
-        return self.query(sql, None, isdict=isdict)
+        sql, params = self._split_sql(self.select_sql(table, where, fields, other))
+        tables = self._cache_tables(table)
+        if tables:
+            return self._cached_query('query', tables, sql, params, isdict)
+        return self.query(sql, params, isdict=isdict)
 
     def select_one(self, table, where=None, fields='*', other=None, isdict=True):
         if not other:
@@ -364,12 +1286,47 @@ class DBConnection:
         if 'limit' not in other:
             other += ' limit 1'
 
-        sql = self.select_sql(table, where, fields, other)
-        return self.get(sql, None, isdict=isdict)
+        sql, params = self._split_sql(self.select_sql(table, where, fields, other))
+        tables = self._cache_tables(table)
+        if tables:
+            return self._cached_query('get', tables, sql, params, isdict)
+        return self.get(sql, params, isdict=isdict)
+
+    def _cache_tables(self, table):
+        '''查询的表都配置在cache_tables中时返回表名列表，否则返回None'''
+        cache_tables = self.param.get('cache_tables')
+        if not cache_tables or self.trans:
+            return None
+        tables = call_tables('select', (table,), {})
+        for t in tables:
+            if t not in cache_tables:
+                return None
+        return tables
+
+    def _cached_query(self, method, tables, sql, params, isdict):
+        '''method为query或get，query和get的结果不同，放入key中'''
+        func = getattr(self, method)
+        try:
+            key = (self.name, method, sql.strip(), tuple(params or ()), isdict)
+            hash(key)
+        except TypeError:
+            return func(sql, params, isdict=isdict)
+        rw = self.pool.rw if self.pool else None
+        if self.role == 's' and rw is not None and rw.recent_write(tables):
+            # 表刚在主库写过，从库可能还没有同步，一致性窗口内从库的读不使用也不放入缓存
+            return func(sql, params, isdict=isdict)
+
+        found, ret = result_cache.get(key, tables)
+        if found:
+            return ret
+        version = result_cache.version(self.name, tables)
+        ret = func(sql, params, isdict=isdict)
+        result_cache.put(key, self.name, tables, ret, self.param.get('cache_ttl', 60), version)
+        return ret
 
     def select_join(self, table1, table2, join_type='inner', on=None, where=None, fields='*', other=None, isdict=True):
-        sql = self.select_join_sql(table1, table2, join_type, on, where, fields, other)
-        return self.query(sql, None, isdict=isdict)
+        sql, params = self._split_sql(self.select_join_sql(table1, table2, join_type, on, where, fields, other))
+        return self.query(sql, params, isdict=isdict)
 
     def select_join_one(self, table1, table2, join_type='inner', on=None, where=None, fields='*', other=None, isdict=True):
         if not other:
@@ -377,10 +1334,23 @@ class DBConnection:
         if 'limit' not in other:
             other += ' limit 1'
 
-        sql = self.select_join_sql(table1, table2, join_type, on, where, fields, other)
-        return self.get(sql, None, isdict=isdict)
-
-    def select_sql(self, table, where=None, fields='*', other=None):
+        sql, params = self._split_sql(self.select_join_sql(table1, table2, join_type, on, where, fields, other))
+        return self.get(sql, params, isdict=isdict)
+
+    def select_sql(self, table, where=None, fields='*', other=None, placeholder=None):
+        placeholder = self._use_placeholder(placeholder)
+        where = _norm_where(where)
+        key = ('select', self.__class__, table, self.fields_shape(fields),
+                self.where_shape(where), other)
+        tpl = sql_cache.get(key)
+        if tpl is None:
+            tpl = self._compile_sql(self._select_sql(table, where, fields, other))
+            sql_cache.put(key, tpl)
+        values = self.dict2values(where) if where else []
+        return self._fill_sql(tpl, values, placeholder)
+
+    def _select_sql(self, table, where=None, fields='*', other=None):
+        params = []
         if isinstance(fields, (list, tuple)):
             fields = ','.join([ self.field2sql(x) for x in fields ])
         else:
@@ -388,12 +1358,30 @@ class DBConnection:
 
         sql = "select %s from %s" % (fields, self.format_table(table))
         if where:
-            sql += " where %s" % self.dict2sql(where, ' and ')
+            sql += " where %s" % self.dict2sql(where, ' and ', params)
         if other:
             sql += ' ' + other
         return sql
 
-    def select_join_sql(self, table1, table2, join_type='inner', on=None, where=None, fields='*', other=None):
+    def select_join_sql(self, table1, table2, join_type='inner', on=None, where=None, fields='*', other=None, placeholder=None):
+        placeholder = self._use_placeholder(placeholder)
+        on = _norm_where(on)
+        where = _norm_where(where)
+        key = ('join', self.__class__, table1, table2, join_type, self.where_shape(on, True),
+                self.fields_shape(fields), self.where_shape(where), other)
+        tpl = sql_cache.get(key)
+        if tpl is None:
+            tpl = self._compile_sql(self._select_join_sql(table1, table2, join_type, on, where, fields, other))
+            sql_cache.put(key, tpl)
+        values = []
+        if on:
+            self.dict2values(on, values, True)
+        if where:
+            self.dict2values(where, values)
+        return self._fill_sql(tpl, values, placeholder)
+
+    def _select_join_sql(self, table1, table2, join_type='inner', on=None, where=None, fields='*', other=None):
+        params = []
         if isinstance(fields, (list, tuple)):
             fields = ','.join([ self.field2sql(x) for x in fields ])
         else:
@@ -401,25 +1389,95 @@ class DBConnection:
 
         sql = "select %s from %s %s join %s" % (fields, self.format_table(table1), join_type, self.format_table(table2))
         if on:
-            sql += " on %s" % self.dict2on(on, ' and ')
+            sql += " on %s" % self.dict2on(on, ' and ', params)
         if where:
-            sql += " where %s" % self.dict2sql(where, ' and ')
+            sql += " where %s" % self.dict2sql(where, ' and ', params)
         if other:
             sql += ' ' + other
         return sql
 
-    def select_page(self, sql, pagecur=1, pagesize=20, count_sql=None, maxid=-1):
-        return pager.db_pager(self, sql, pagecur, pagesize, count_sql, maxid)
+    def fields_shape(self, fields):
+        if isinstance(fields, (list, tuple)):
+            return tuple(fields)
+        return fields
+
+    def where_shape(self, d, on=False):
+        '''where条件的形状: 字段名、操作符、列表长度和DBFunc，不包括具体的值
+        on - join的on条件，等号右边是字段名，直接写在sql中，要放入形状
+        '''
+        if not d:
+            return None
+        shape = []
+        for k,v in d.items():
+            if isinstance(v, (tuple,list)):
+                shape.append((k, v[0], _value_shape(v[1])))
+            elif on:
+                shape.append((k, '=', v))
+            else:
+                shape.append((k, _value_shape(v)))
+        return tuple(shape)
+
+    def exp2values(self, op, value, out):
+        '''按exp2sql生成占位符的顺序取出值'''
+        if op in ('in', 'not in'):
+            out.extend([x for x in value if not isinstance(x, DBFunc)])
+        elif op == 'between':
+            out.extend([x for x in value[:2] if not isinstance(x, DBFunc)])
+        elif not isinstance(value, DBFunc):
+            out.append(value)
+
+    def dict2values(self, d, out=None, on=False):
+        '''按dict2sql/dict2on生成占位符的顺序取出值'''
+        if out is None:
+            out = []
+        for k,v in d.items():
+            if isinstance(v, (tuple,list)):
+                self.exp2values(v[0], v[1], out)
+            elif not on and not isinstance(v, DBFunc):
+                out.append(v)
+        return out
+
+    def _compile_sql(self, sql):
+        '''把带内部占位符的sql编译为模板: (字面值片段, 驱动占位符sql)'''
+        parts = sql.split(PARAM_MARK)
+        bound = sql
+        if len(parts) > 1:
+            bound = self._bind_sql(sql, [None])[0]
+        return parts, bound
+
+    def _fill_sql(self, tpl, values, placeholder):
+        parts, bound = tpl
+        if placeholder:
+            return bound, values
+        if len(parts) == 1:
+            return parts[0]
+        x = [parts[0]]
+        for i in range(0, len(values)):
+            x.append(self.value2sql(values[i]))
+            x.append(parts[i+1])
+        return ''.join(x)
+
+    def select_page(self, sql, pagecur=1, pagesize=20, count_sql=None, maxid=-1, order=None, cursor=None, **kw):
+        return pager.db_pager(self, sql, pagecur, pagesize, count_sql, maxid, order, cursor, **kw)
 
     def select_page_simple(self, tb, page=1, pagesize=20, where=None, fields='*', other=None,
-            count_sql=None, maxid=-1):
-        sql = self.select_sql(tb, where, fields, other)
-        p = self.select_page(sql, page, pagesize, count_sql, maxid)
+            count_sql=None, maxid=-1, order=None, cursor=None, **kw):
+        '''order不为空时按游标分页: 返回的cursor传入下一次调用
+        kw - count_mode/count_ttl/count_estimate，见pager.count_total
+        '''
+        sql = self.select_sql(tb, where, fields, other, placeholder=False)
+        p = self.select_page(sql, page, pagesize, count_sql, maxid, order, cursor, **kw)
         ret = {}
         ret['page'] = p.page
         ret['pagesize'] = p.page_size
         ret['pagecount'] = p.pages
         ret['data'] = p.pagedata.data
+        if order:
+            ret['cursor'] = p.pagedata.next_cursor
+        if p.pagedata.has_more is not None:
+            ret['has_more'] = p.pagedata.has_more
+        if p.pagedata.estimated:
+            ret['estimated'] = True
 
         return ret
 
@@ -442,15 +1500,79 @@ class DBConnection:
 
     def commit(self):
         self.trans = 0
-        self.conn.commit()
+        try:
+            self.conn.commit()
+        finally:
+            self._trans_done()
 
     def rollback(self):
         self.trans = 0
-        self.conn.rollback()
+        try:
+            self.conn.rollback()
+        finally:
+            self._trans_done()
+
+    @contextmanager
+    def transaction(self):
+        '''事务: 正常退出时提交，异常时回滚。在事务中嵌套调用时使用savepoint'''
+        if not self.trans:
+            self.start()
+            try:
+                yield self
+            except:
+                try:
+                    self.rollback()
+                except:
+                    log.warning(traceback.format_exc())
+                raise
+            self.commit()
+            return
+
+        self._savepoint += 1
+        name = 'sp_%d' % self._savepoint
+        try:
+            self.execute('savepoint %s' % name)
+            try:
+                yield self
+            except:
+                self.execute('rollback to savepoint %s' % name)
+                raise
+            self.execute('release savepoint %s' % name)
+        finally:
+            self._savepoint -= 1
+
+    def reset(self):
+        '''归还连接池前重置会话状态: 回滚未结束的事务'''
+        if self.trans:
+            log.warning('func=reset|name=%s|error=transaction not finished, rollback', self.name)
+            self.rollback()
+        self._savepoint = 0
 
     def escape(self, s):
         return s
 
+    def row_converter(self, cur):
+        '''根据cur.description生成行转换函数，结果同format_timestamp，不需要转换时返回None'''
+        global settings
+        if not settings.get('format_time') or not cur.description:
+            return None
+
+        index = []
+        for i,d in enumerate(cur.description):
+            if d[0].endswith('time'):
+                index.append(i)
+        if not index:
+            return list
+
+        fromtimestamp = TimestampDatetime.fromtimestamp
+        def conv(ret):
+            res = list(ret)
+            for i in index:
+                if isinstance(res[i], int):
+                    res[i] = fromtimestamp(res[i])
+            return res
+        return conv
+
     def format_timestamp(self, ret, cur):
         '''将字段以_time结尾的格式化成datetime'''
         global settings
@@ -467,7 +1589,7 @@ class DBConnection:
         res = []
         for i , t in enumerate(ret):
             if i in index and isinstance(t, int):
-                res.append(datetime.datetime.fromtimestamp(t))
+                res.append(TimestampDatetime.fromtimestamp(t))
             else:
                 res.append(t)
         return res
@@ -476,6 +1598,7 @@ def with_mysql_reconnect(func):
 
     def close_mysql_conn(self):
         log.info('close conn:%s', self.conn)
+        self._trans_reset()
         try:
             self.conn.close()
         except:
@@ -497,6 +1620,7 @@ def with_mysql_reconnect(func):
                 log.warning(traceback.format_exc())
                 if e.args[0] >= 2000 and self.trans == 0: # 连接断开错误
                     close_mysql_conn(self)
+                    metrics.incr('reconnect', self.pool.key if self.pool else self.name)
                     self.connect()
                     trycount -= 1
                     if trycount > 0:
@@ -507,6 +1631,7 @@ def with_mysql_reconnect(func):
                 log.warning(traceback.format_exc())
                 if self.trans == 0: # 连接断开错误
                     close_mysql_conn(self)
+                    metrics.incr('reconnect', self.pool.key if self.pool else self.name)
                     self.connect()
                     trycount -= 1
                     if trycount > 0:
@@ -545,6 +1670,7 @@ class MySQLConnection (DBConnection):
                                         )
 
             self.conn.autocommit(1)
+            self._trans_reset()
 
             cur = self.conn.cursor()
             cur.execute("show variables like 'server_id'")
@@ -578,12 +1704,20 @@ class MySQLConnection (DBConnection):
 
     def close(self):
         log.info('server=%s|func=close|id=%d', self.type, self.conn_id%10000)
+        self._trans_reset()
         try:
             self.conn.close()
         except:
             log.warning(traceback.format_exc())
         self.conn = None
 
+    def ss_cursor(self):
+        if self.param['engine'] == 'mysql':
+            import MySQLdb.cursors
+            return self.conn.cursor(MySQLdb.cursors.SSCursor)
+        import pymysql.cursors
+        return self.conn.cursor(pymysql.cursors.SSCursor)
+
     @with_mysql_reconnect
     def alive(self):
         if self.is_available():
@@ -635,12 +1769,18 @@ class MySQLConnection (DBConnection):
     def commit(self):
         self.trans = 0
         sql = 'commit'
-        return self.execute(sql)
+        try:
+            return self.execute(sql)
+        finally:
+            self._trans_done()
 
     def rollback(self):
         self.trans = 0
         sql = 'rollback'
-        return self.execute(sql)
+        try:
+            return self.execute(sql)
+        finally:
+            self._trans_done()
 
 class PyMySQLConnection (MySQLConnection):
     type = "pymysql"
@@ -660,7 +1800,7 @@ class PyMySQLConnection (MySQLConnection):
                                         connect_timeout = self.param.get('timeout', 10),
                                         )
             self.conn.autocommit(1)
-            self.trans = 0
+            self._trans_reset()
 
             cur = self.conn.cursor()
             cur.execute("show variables like 'server_id'")
@@ -688,8 +1828,10 @@ class PyMySQLCKConnection (MySQLConnection):
 
     def __init__(self, param, lasttime, status):
         MySQLConnection.__init__(self, param, lasttime, status)
+        # clickhouse 只使用转义后的字面值sql
+        self.placeholder = False
 
-    def dict2sql(self, d, sp=','):
+    def dict2sql(self, d, sp=',', params=None):
         x = []
         for k,v in d.items():
             # k, v:
@@ -699,12 +1841,12 @@ class PyMySQLCKConnection (MySQLConnection):
                 # 如果 like 传入列表，那么 使用 and 进行查询
                 if isinstance(v[1], list) and v[0] == 'like':
                     for vv in v[1]:
-                        x.append('%s' % self.exp2sql(k, v[0], vv))
+                        x.append('%s' % self.exp2sql(k, v[0], vv, params))
                 else:
-                    x.append('%s' % self.exp2sql(k, v[0], v[1]))
+                    x.append('%s' % self.exp2sql(k, v[0], v[1], params))
             else:
                 x.append('`%s`=%s' % (k.replace('.','`.`'),
-                    self.value2sql(v)))
+                    self.value2sql(v, params=params)))
             # x:
             # [
             #     "(`log_time` between  '2022-08-22 00:00:00' and '2022-08-25 09:39:47')",
@@ -714,6 +1856,17 @@ class PyMySQLCKConnection (MySQLConnection):
             # ]
         return sp.join(x)
 
+    def dict2values(self, d, out=None, on=False):
+        if out is None:
+            out = []
+        for k,v in d.items():
+            if isinstance(v, (tuple,list)) and isinstance(v[1], list) and v[0] == 'like':
+                for vv in v[1]:
+                    self.exp2values(v[0], vv, out)
+            else:
+                DBConnection.dict2values(self, {k:v}, out, on)
+        return out
+
     def connect(self):
         engine = self.param['engine']
         if engine != 'pymysqlck':
@@ -730,7 +1883,7 @@ class PyMySQLCKConnection (MySQLConnection):
             connect_timeout = self.param.get('timeout', 10),
         )
         self.conn.autocommit(1)
-        self.trans = 0
+        self._trans_reset()
 
         # cur = self.conn.cursor()
         # cur.execute("show variables like 'server_id'")
@@ -777,36 +1930,213 @@ class PyMySQLCKConnection (MySQLConnection):
     def get(self, sql, param=None, isdict=True):
         return DBConnection.get(self, sql, param, isdict)
 
+SQLITE_WRITE_CP = re.compile(r'^\s*(insert|update|delete|replace)\b', re.I)
+SQLITE_PRAGMA_CP = re.compile(r'^-?\w+$')
+
+def sqlite_open(param):
+    '''打开sqlite连接并按配置设置pragma
+    wal - 使用WAL日志，读写可以并发
+    synchronous/mmap_size/cache_size - 对应的pragma
+    busy_timeout - 数据库被锁时等待的秒数
+    check_same_thread - 为False时连接可以在其他线程使用(adbpool需要)
+    '''
+    import sqlite3
+    conn = sqlite3.connect(param['db'], timeout=param.get('busy_timeout', 5),
+            detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None,
+            check_same_thread=param.get('check_same_thread', True))
+    if param.get('wal'):
+        conn.execute('pragma journal_mode=WAL')
+    for k in ('synchronous', 'mmap_size', 'cache_size'):
+        v = param.get(k)
+        if v is None:
+            continue
+        if not SQLITE_PRAGMA_CP.match(str(v)):
+            raise ValueError('sqlite %s error: %s' % (k, v))
+        conn.execute('pragma %s=%s' % (k, v))
+    return conn
+
+_sqlite_local = threading.local()
+
+def _sqlite_thread_conn(key, param, owner):
+    '''当前线程(或协程)的sqlite连接，同一个连接池的库在一个线程中只打开一次。
+    同一时间只绑定给一个使用者，已被线程中的其他使用者占用时返回None
+    '''
+    conns = getattr(_sqlite_local, 'conns', None)
+    if conns is None:
+        conns = _sqlite_local.conns = {}
+    item = conns.get(key)
+    if item is None:
+        item = conns[key] = [sqlite_open(param), None]
+    if item[1] is not None and item[1] is not owner:
+        return None
+    item[1] = owner
+    return item[0]
+
+def _sqlite_thread_release(key, owner):
+    '''使用者释放当前线程的sqlite连接，连接保持打开'''
+    item = getattr(_sqlite_local, 'conns', {}).get(key)
+    if item is not None and item[1] is owner:
+        item[1] = None
+
+
+class SQLiteWriter (threading.Thread):
+    '''一个库一个写线程，把排队的写语句合并到一个事务中提交'''
+    def __init__(self, param):
+        threading.Thread.__init__(self, name='sqlite-writer')
+        self.daemon = True
+        self.param = param
+        self.batch = param.get('write_batch', 100)
+        self.queue = queue.Queue()
+        self.pid = os.getpid()
+        self.stat = {'batch':0, 'write':0, 'retry':0, 'error':0}
+
+    def submit(self, sql, param, many):
+        from concurrent.futures import Future, TimeoutError
+        fut = Future()
+        self.queue.put((sql, param, many, fut))
+        while True:
+            try:
+                return fut.result(1)
+            except TimeoutError:
+                # 写线程异常退出时不再等待
+                if not self.is_alive():
+                    raise RuntimeError('sqlite writer exited: %s' % self.param['db'])
+
+    def _exec(self, conn, sql, param, many):
+        if many:
+            cur = conn.executemany(sql, param)
+        elif param:
+            cur = conn.execute(sql, param)
+        else:
+            cur = conn.execute(sql)
+        return cur.rowcount, cur.lastrowid
+
+    def run(self):
+        conn = sqlite_open(self.param)
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.stat['batch'] += 1
+            self.stat['write'] += len(items)
+            try:
+                conn.execute('begin immediate')
+                rets = [self._exec(conn, *x[:3]) for x in items]
+                conn.execute('commit')
+            except Exception:
+                try:
+                    conn.execute('rollback')
+                except Exception:
+                    pass
+                # 批量失败后逐条执行，错误只返回给出错的语句
+                self.stat['retry'] += 1
+                for x in items:
+                    try:
+                        x[3].set_result(self._exec(conn, *x[:3]))
+                    except Exception as e:
+                        self.stat['error'] += 1
+                        x[3].set_exception(e)
+                continue
+            for x,ret in zip(items, rets):
+                x[3].set_result(ret)
+
+_sqlite_writers = {}
+_sqlite_writers_lock = threading.Lock()
+
+def sqlite_writer(param):
+    '''库对应的写线程，fork后的子进程中重新创建'''
+    with _sqlite_writers_lock:
+        w = _sqlite_writers.get(param['db'])
+        if w is None or w.pid != os.getpid() or not w.is_alive():
+            w = _sqlite_writers[param['db']] = SQLiteWriter(param)
+            w.start()
+        return w
+
+
 class SQLiteConnection (DBConnection):
+    '''配置项:
+    wal/synchronous/mmap_size/cache_size/busy_timeout - 见sqlite_open
+    thread_conn - 每个线程(协程)复用一个连接，不再每次使用都重新打开。
+        同一个线程同时使用连接池的多个连接时，线程的连接只给第一个，其他的单独打开连接
+    write_queue - 事务外的insert/update/delete交给写线程，合并提交，write_batch为每批最多条数
+    '''
     type = "sqlite"
+    param_mark = '?'
+    explain_prefix = 'explain query plan '
     def __init__(self, param, lasttime, status):
         DBConnection.__init__(self, param, lasttime, status)
+        self._lastrowid = None
+        # 当前使用的是线程的连接
+        self._thread_conn = False
+
+    def _thread_key(self):
+        return (self.pool.key if self.pool else self.name, self.param['db'])
 
     def connect(self):
         engine = self.param['engine']
-        self.trans = 0
+        self._trans_reset()
         if engine == 'sqlite':
-            import sqlite3
-            self.conn = sqlite3.connect(self.param['db'], detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+            self.conn = None
+            if self.param.get('thread_conn'):
+                self.conn = _sqlite_thread_conn(self._thread_key(), self.param, self)
+            self._thread_conn = self.conn is not None
+            if self.conn is None:
+                self.conn = sqlite_open(self.param)
         else:
             raise ValueError('engine error:' + engine)
 
     def useit(self):
         DBConnection.useit(self)
-        if not self.conn:
+        if not self.conn or self.param.get('thread_conn'):
             self.connect()
 
     def releaseit(self):
         DBConnection.releaseit(self)
+        self._lastrowid = None
+        if self._thread_conn:
+            # 线程的连接不关闭，连接对象回到连接池，下次使用时绑定到使用者线程的连接
+            _sqlite_thread_release(self._thread_key(), self)
+            self._thread_conn = False
+            return
         self.conn.close()
         self.conn = None
 
+    def _queued(self, sql):
+        return self.param.get('write_queue') and not self.trans and SQLITE_WRITE_CP.match(sql)
+
+    def execute(self, sql, param=None):
+        if self._queued(sql):
+            return self._write(sql, param)
+        # 不经过写线程时用连接自己的last_insert_rowid
+        self._lastrowid = None
+        return DBConnection.execute(self, sql, param)
+
+    def executemany(self, sql, param=None):
+        if self._queued(sql):
+            return self._write(sql, param, True)
+        self._lastrowid = None
+        return DBConnection.executemany(self, sql, param)
+
+    @timeit
+    def _write(self, sql, param=None, many=False):
+        try:
+            ret, self._lastrowid = sqlite_writer(self.param).submit(sql, param, many)
+            return ret
+        finally:
+            self._on_write('execute', sql)
+
     def escape(self, s, enc='utf-8'):
         s = s.replace("'", "\'")
         s = s.replace('"', '\"')
         return s
 
     def last_insert_id(self):
+        if self._lastrowid is not None:
+            # 写线程执行的插入
+            return self._lastrowid
         ret = self.query('select last_insert_rowid()', isdict=False)
         return ret[0][0]
 
@@ -818,14 +2148,34 @@ class SQLiteConnection (DBConnection):
 
 
 class DBPool (DBPoolBase):
-    def __init__(self, dbcf):
-        # one item: [conn, last_get_time, stauts]
-        self.dbconn_idle  = []
-        self.dbconn_using = []
+    def __init__(self, dbcf, warm=True):
+        # 空闲连接，左侧为最近归还的连接
+        self.dbconn_idle  = collections.deque()
+        # 使用中的连接
+        self.dbconn_using = set()
 
         self.dbcf   = dbcf
+        # 所属的读写分离连接池
+        self.rw     = None
+        # 指标中使用的连接池标识
+        self.key    = '%s/%s@%s:%s' % (dbcf.get('name', ''), dbcf.get('role', 'm'),
+                dbcf.get('host', dbcf.get('db', '')), dbcf.get('port', ''))
         self.max_conn = 20
-        self.min_conn = 1
+        self.min_conn = dbcf.get('min_conn', 1)
+        # 连接总数，包括正在建立中的连接
+        self.nconn = 0
+        # 后台维护计数
+        self.maint = {'run':0, 'evict':0, 'fill':0, 'ping':0, 'ping_fail':0, 'eject':0}
+        # 查询耗时的指数加权平均(微秒)
+        self.ewma = 0.0
+        self.ewma_alpha = dbcf.get('ewma_alpha', 0.2)
+        # 连接或ping失败后摘除到该时间
+        self.down_until = 0
+        # 启动时预建的连接数，多出min_conn的部分空闲超时后会被回收
+        self.warm_conn = dbcf.get('warmup', self.min_conn)
+        # 预热状态: 预热完成前ready为False
+        self.ready = False
+        self.warm = {'want':0, 'open':0, 'fail':0, 'time':0}
 
         #if self.dbcf.has_key('conn'):
         if 'conn' in self.dbcf:
@@ -841,7 +2191,48 @@ class DBPool (DBPoolBase):
         self.lock = threading.Lock()
         self.cond = threading.Condition(self.lock)
 
-        self.open(self.min_conn)
+        if warm:
+            self.warmup()
+
+    def warmup(self, n=None):
+        '''并行建立n个连接(默认warmup配置)，完成后ready置为True'''
+        if n is None:
+            n = self.warm_conn
+        n = min(max(n - self.nconn, 0), self.max_conn - self.nconn)
+        starttm = time.time()
+        conns = []
+        errors = []
+
+        def _open():
+            try:
+                conns.append(self._new_conn())
+            except Exception as e:
+                errors.append(e)
+
+        if n > 1:
+            ths = [threading.Thread(target=_open, name='dbpool-warmup') for i in range(n)]
+            for th in ths:
+                th.start()
+            for th in ths:
+                th.join()
+        elif n == 1:
+            _open()
+
+        with self.lock:
+            self.dbconn_idle.extend(conns)
+            self.nconn += len(conns)
+            self.cond.notify_all()
+        self.warm = {'want':n, 'open':len(conns), 'fail':len(errors),
+                     'time':int((time.time()-starttm)*1000000)}
+        log.info('func=warmup|pool=%s|want=%d|open=%d|fail=%d|time=%d', self.key,
+                n, len(conns), len(errors), self.warm['time'])
+        if errors:
+            # 从库启动时连不上不影响服务，先摘除
+            if self.dbcf.get('role') != 's':
+                raise errors[0]
+            log.warning('func=warmup|pool=%s|error=%s', self.key, errors[0])
+            self.mark_down()
+        self.ready = True
 
     def synchronize(func):
         def _(self, *args, **argitems):
@@ -854,81 +2245,216 @@ class DBPool (DBPoolBase):
             return x
         return _
 
-    def open(self, n=1):
+    def _new_conn(self):
         param = self.dbcf
+        try:
+            myconn = self.connection_class[param['engine']](param, time.time(), 0)
+        except:
+            metrics.incr('connect_fail', self.key)
+            raise
+        metrics.incr('connect', self.key)
+        myconn.pool = self
+        return myconn
+
+    def open(self, n=1):
         newconns = []
         for i in range(0, n):
-            myconn = self.connection_class[param['engine']](param, time.time(), 0)
-            myconn.pool = self
-            newconns.append(myconn)
-        self.dbconn_idle += newconns
+            newconns.append(self._new_conn())
+        with self.lock:
+            self.dbconn_idle.extend(newconns)
+            self.nconn += len(newconns)
+
+    def _drop(self, conn):
+        '''连接已从池中移除，关闭连接并释放计数，需在锁外调用'''
+        with self.lock:
+            self.nconn -= 1
+            self.cond.notify()
+        if conn and conn.conn:
+            conn.close()
 
     def clear_timeout(self):
         #log.info('try clear timeout conn ...')
         now = time.time()
         dels = []
-        allconn = len(self.dbconn_idle) + len(self.dbconn_using)
+        keeps = collections.deque()
+        allconn = self.nconn
         for c in self.dbconn_idle:
-            if allconn == 1:
-                break
-            if now - c.lasttime > self.dbcf.get('idle_timeout', 10):
+            if allconn > max(self.min_conn, 1) and now - c.lasttime > self.dbcf.get('idle_timeout', 10):
                 dels.append(c)
                 allconn -= 1
+            else:
+                keeps.append(c)
 
-        if dels:
-            log.debug('close timeout db conn:%d', len(dels))
-        for c in dels:
-            if c.conn:
-                c.close()
-            self.dbconn_idle.remove(c)
+        if not dels:
+            return
+        log.debug('close timeout db conn:%d', len(dels))
+        self.dbconn_idle = keeps
+        self.nconn -= len(dels)
+        self.maint['evict'] += len(dels)
+        return dels
 
-    @synchronize
     def acquire(self, timeout=10):
         start = time.time()
-        while len(self.dbconn_idle) == 0:
-            if len(self.dbconn_idle) + len(self.dbconn_using) < self.max_conn:
-                self.open()
-                continue
-            self.cond.wait(timeout)
-            if int(time.time() - start) > timeout:
-                log.error('func=acquire|error=no idle connections')
-                raise RuntimeError('no idle connections')
-
-        conn = self.dbconn_idle.pop(0)
-        conn.useit()
-        self.dbconn_using.append(conn)
+        conn = None
+        with self.lock:
+            while not self.dbconn_idle:
+                if self.nconn < self.max_conn:
+                    # 先占位，在锁外建立连接
+                    self.nconn += 1
+                    break
+                self.cond.wait(timeout)
+                if int(time.time() - start) > timeout:
+                    log.error('func=acquire|error=no idle connections')
+                    metrics.incr('acquire_timeout', self.key)
+                    raise RuntimeError('no idle connections')
+            else:
+                conn = self.dbconn_idle.popleft()
+                self.dbconn_using.add(conn)
 
-        if random.randint(0, 100) > 80:
+        if conn is None:
             try:
-                self.clear_timeout()
+                conn = self._new_conn()
             except:
-                log.error(traceback.format_exc())
+                self._drop(None)
+                self.mark_down()
+                raise
+            self.down_until = 0
+            with self.lock:
+                self.dbconn_using.add(conn)
 
+        try:
+            conn.useit()
+        except:
+            with self.lock:
+                self.dbconn_using.discard(conn)
+            self._drop(conn)
+            self.mark_down()
+            raise
+        metrics.observe('acquire_wait', self.key, int((time.time()-start)*1000000))
         return conn
 
-    @synchronize
     def release(self, conn):
-        if conn:
-            if conn.trans:
-                log.debug('realse close conn use transaction')
+        if not conn:
+            with self.lock:
+                self.cond.notify()
+            return
+
+        try:
+            conn.close_stream()
+        except:
+            log.warning(traceback.format_exc())
+
+        if conn.trans:
+            # 回滚未结束的事务后连接可以复用，回滚失败再关闭
+            try:
+                conn.reset()
+            except:
+                log.warning(traceback.format_exc())
                 conn.close()
-                #conn.connect()
 
+        conn.releaseit()
+        conn.writes = 0
+        with self.lock:
             self.dbconn_using.remove(conn)
-            conn.releaseit()
             if conn.conn:
-                self.dbconn_idle.insert(0, conn)
-        self.cond.notify()
-
+                self.dbconn_idle.appendleft(conn)
+            else:
+                self.nconn -= 1
+            self.cond.notify()
 
     @synchronize
     def alive(self):
         for conn in self.dbconn_idle:
             conn.alive()
 
+    def maintain(self):
+        '''后台维护: 关闭超时空闲连接，保持最小连接数，在服务端超时前ping空闲连接'''
+        now = time.time()
+        ping_interval = self.dbcf.get('ping_interval', 300)
+        pings = []
+        metrics.observe('idle', self.key, len(self.dbconn_idle), bounds=SIZE_BUCKETS)
+        metrics.observe('using', self.key, len(self.dbconn_using), bounds=SIZE_BUCKETS)
+        with self.lock:
+            self.maint['run'] += 1
+            dels = self.clear_timeout() or []
+            # 需要ping的连接先从空闲队列中取出，在锁外ping
+            keeps = collections.deque()
+            for c in self.dbconn_idle:
+                if c.conn and now - max(c.lasttime, c.pingtime) > ping_interval:
+                    pings.append(c)
+                else:
+                    keeps.append(c)
+            if pings:
+                self.dbconn_idle = keeps
+                self.dbconn_using.update(pings)
+            fill = max(self.min_conn - self.nconn, 0)
+            self.nconn += fill
+
+        for c in dels:
+            if c.conn:
+                c.close()
+
+        for c in pings:
+            try:
+                c.alive()
+                c.pingtime = time.time()
+                self.maint['ping'] += 1
+            except:
+                log.warning(traceback.format_exc())
+                self.maint['ping_fail'] += 1
+                self.mark_down()
+                with self.lock:
+                    self.dbconn_using.discard(c)
+                self._drop(c)
+                continue
+            with self.lock:
+                self.dbconn_using.discard(c)
+                self.dbconn_idle.append(c)
+                self.cond.notify()
+
+        for i in range(0, fill):
+            try:
+                c = self._new_conn()
+            except:
+                log.warning(traceback.format_exc())
+                self._drop(None)
+                self.mark_down()
+                continue
+            self.down_until = 0
+            with self.lock:
+                self.dbconn_idle.append(c)
+                self.maint['fill'] += 1
+                self.cond.notify()
+
     def size(self):
         return len(self.dbconn_idle), len(self.dbconn_using)
 
+    def stats(self):
+        '''连接池当前状态'''
+        return {'key':self.key, 'idle':len(self.dbconn_idle), 'using':len(self.dbconn_using),
+                'nconn':self.nconn, 'max_conn':self.max_conn, 'min_conn':self.min_conn,
+                'ewma':int(self.ewma), 'up':self.is_up(), 'maint':dict(self.maint),
+                'ready':self.ready, 'warm':dict(self.warm)}
+
+    def record_latency(self, usec):
+        '''记录一次查询耗时，更新指数加权平均'''
+        if self.ewma:
+            self.ewma += self.ewma_alpha * (usec - self.ewma)
+        else:
+            self.ewma = float(usec)
+
+    def mark_down(self):
+        '''连接或ping失败，在eject_time秒内不再分配读请求'''
+        if not self.is_up():
+            return
+        self.down_until = time.time() + self.dbcf.get('eject_time', 10)
+        self.maint['eject'] += 1
+        log.warning('func=mark_down|name=%s|addr=%s:%d|until=%d', self.dbcf.get('name',''),
+                self.dbcf.get('host',''), self.dbcf.get('port',0), self.down_until)
+
+    def is_up(self):
+        return time.time() >= self.down_until
+
 
 class DBConnProxy:
     #def __init__(self, masterconn, slaveconn):
@@ -943,40 +2469,190 @@ class DBConnProxy:
         self._timeout = timeout
 
         self._modify_methods = set(['execute', 'executemany', 'last_insert_id',
-                'insert', 'update', 'delete', 'insert_list', 'start', 'rollback', 'commit'])
+                'insert', 'update', 'delete', 'insert_list', 'start', 'rollback', 'commit',
+                'transaction'])
+
+    def _get_master(self):
+        if not self._master:
+            self._master = self._pool.master.acquire(self._timeout)
+        return self._master
+
+    def _get_slave(self):
+        if not self._slave:
+            self._slave = self._pool.acquire_slave(self._timeout)
+        return self._slave
 
     def __getattr__(self, name):
         #if name.startswith('_') and name[1] != '_':
         #    return self.__dict__[name]
+        consistency = self._pool.consistency
         if name in self._modify_methods:
-            if not self._master:
-                self._master = self._pool.master.acquire(self._timeout)
-            return getattr(self._master, name)
+            # table模式的写入时间由主库连接在写操作(或事务提交)时记录
+            return getattr(self._get_master(), name)
         else:
             if name == 'master':
-                if not self._master:
-                    self._master = self._pool.master.acquire(self._timeout)
-                return self._master
+                return self._get_master()
             if name == 'slave':
-                if not self._slave:
-                    self._slave = self._pool.get_slave().acquire(self._timeout)
-                return self._slave
+                return self._get_slave()
+
+            if consistency == 'session' and self._master is not None and self._master.writes:
+                # 读自己的写: 在主库连接上写过之后(包括通过master和事务写)的读都走主库
+                return getattr(self._get_master(), name)
+            if consistency == 'table' and name in READ_TABLE_ARG:
+                # 最近写过的表在时间窗口内读主库
+                def _(*args, **kw):
+                    if self._pool.recent_write(call_tables(name, args, kw)):
+                        conn = self._get_master()
+                    else:
+                        conn = self._get_slave()
+                    return getattr(conn, name)(*args, **kw)
+                return _
+            return getattr(self._get_slave(), name)
+
+
+# 读写方法中表名(或sql)参数的位置和参数名，用于按表的读写一致性
+READ_TABLE_ARG = {
+    'select': ((0, 'table'),),
+    'select_one': ((0, 'table'),),
+    'select_join': ((0, 'table1'), (1, 'table2')),
+    'select_join_one': ((0, 'table1'), (1, 'table2')),
+    'select_page_simple': ((0, 'tb'),),
+    'query': ((0, 'sql'),),
+    'get': ((0, 'sql'),),
+    'query_iter': ((0, 'sql'),),
+}
+
+WRITE_TABLE_ARG = {
+    'insert': ((0, 'table'),),
+    'insert_list': ((0, 'table'),),
+    'update': ((0, 'table'),),
+    'delete': ((0, 'table'),),
+    'execute': ((0, 'sql'),),
+    'executemany': ((0, 'sql'),),
+}
 
-            if not self._slave:
-                self._slave = self._pool.get_slave().acquire(self._timeout)
-            return getattr(self._slave, name)
+SQL_NAME = r'(?:`[^`]+`|\w+)(?:\s*\.\s*(?:`[^`]+`|\w+))?'
+SQL_QUOTE_CP = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"|--[^\n]*|#[^\n]*|/\*.*?\*/", re.S)
+SQL_REF_CP = re.compile(r'\b(from|join|into|update|table)\s+(%s)' % SQL_NAME, re.I)
+# 表名后的别名，不能是关键字
+SQL_ALIAS = (r'\s+(?:as\s+)?(?!(?:where|join|left|right|inner|outer|cross|natural|straight_join|'
+        r'on|using|group|order|limit|having|union|for|lock|partition|use|force|ignore|set|values)\b)\w+')
+# from后逗号分隔的多个表，表可以有别名
+SQL_LIST_CP = re.compile(r'(?:%s)?\s*,\s*(%s)' % (SQL_ALIAS, SQL_NAME), re.I)
+SQL_UPDATE_SKIP_CP = re.compile(r'\b(?:for|key)\s*$', re.I)
+# 括号前的函数名，括号前是这些关键字时不是函数调用
+SQL_FUNC_CP = re.compile(r'(\w+)\s*$')
+SQL_FUNC_SKIP = set(['from', 'join', 'in', 'exists', 'as', 'on', 'and', 'or', 'not', 'any', 'all',
+        'some', 'union', 'where', 'select', 'into', 'values', 'lateral'])
+SQL_SUBQUERY_CP = re.compile(r'\s*(?:select|with)\b', re.I)
+
+def mask_sql(sql):
+    '''字符串和注释换成等长的空白，其他内容的位置不变'''
+    def mask(m):
+        x = m.group()
+        if x[0] in '\'"':
+            return "'%s'" % (' ' * (len(x) - 2))
+        return ' ' * len(x)
+    return SQL_QUOTE_CP.sub(mask, sql)
+
+def _in_func(text, pos):
+    '''pos是否在函数调用的括号中，如extract(year from ctime)，子查询的括号不算'''
+    depth = 0
+    for i in range(pos - 1, -1, -1):
+        c = text[i]
+        if c == ')':
+            depth += 1
+        elif c == '(':
+            if depth:
+                depth -= 1
+                continue
+            if SQL_SUBQUERY_CP.match(text, i + 1):
+                return False
+            m = SQL_FUNC_CP.search(text, 0, i)
+            return bool(m) and m.group(1).lower() not in SQL_FUNC_SKIP
+    return False
+
+@functools.lru_cache(maxsize=4096)
+def sql_table_refs(sql):
+    '''sql中引用表的位置: ((开始, 结束, 表名, 关键字), ...)，表名小写并去掉库名和引号，
+    开始和结束为原sql中表名(含库名和引号)的位置。
+    支持select/join/子查询/insert into/replace into/update/delete from，字符串和注释中的内容忽略
+    '''
+    text = mask_sql(sql)
+    ret = []
+    def add(m, i, kw):
+        name = m.group(i).split('.')[-1].strip('` ').lower()
+        ret.append((m.start(i), m.end(i), name, kw))
+    for m in SQL_REF_CP.finditer(text):
+        kw = m.group(1).lower()
+        # for update/on duplicate key update不是表名
+        if kw == 'update' and SQL_UPDATE_SKIP_CP.search(text, 0, m.start()):
+            continue
+        # extract(year from ctime)/trim(x from y)中的from不是表名
+        if kw == 'from' and _in_func(text, m.start()):
+            continue
+        add(m, 2, kw)
+        if kw == 'from':
+            pos = m.end()
+            while True:
+                x = SQL_LIST_CP.match(text, pos)
+                if not x:
+                    break
+                add(x, 1, kw)
+                pos = x.end()
+    return tuple(ret)
+
+@functools.lru_cache(maxsize=4096)
+def sql_tables(sql):
+    '''sql中引用的表名(小写，去掉库名和引号)，按出现顺序去重'''
+    ret = []
+    for start,end,name,kw in sql_table_refs(sql):
+        if name not in ret:
+            ret.append(name)
+    return tuple(ret)
+
+def call_tables(name, args, kw):
+    '''从方法调用参数中取出涉及的表名'''
+    tables = []
+    for pos,key in READ_TABLE_ARG.get(name) or WRITE_TABLE_ARG.get(name) or ():
+        if len(args) > pos:
+            v = args[pos]
+        else:
+            v = kw.get(key)
+        if not v:
+            continue
+        if key == 'sql':
+            if not isinstance(v, str):
+                continue
+            tables.extend(sql_tables(v))
+            continue
+        for x in v.split(','):
+            if x.strip():
+                tables.append(x.split()[0].split('.')[-1].strip('` ').lower())
+    return tables
 
 
 class RWDBPool:
-    def __init__(self, dbcf):
+    def __init__(self, dbcf, warm=True):
         self.dbcf   = dbcf
         self.name   = ''
         self.policy = dbcf.get('policy', 'round_robin')
+        # 读写一致性: eventual(读从库)/session(写过后读主库)/table(表写后窗口内读主库)
+        self.consistency = dbcf.get('consistency', 'eventual')
+        self.consistency_window = dbcf.get('consistency_window', 2)
+        # 表名 => 最后写入时间
+        self._write_time = {}
 
         master_cf = dbcf.get('master', None)
         master_cf['name'] = dbcf.get('name', '')
         master_cf['role'] = 'm'
-        self.master = DBPool(master_cf)
+        for k in ('cache_tables', 'cache_ttl', 'min_conn', 'warmup'):
+            if k in dbcf:
+                master_cf.setdefault(k, dbcf[k])
+                for x in dbcf.get('slave', []):
+                    x.setdefault(k, dbcf[k])
+        self.master = DBPool(master_cf, warm)
+        self.master.rw = self
 
         self.slaves = []
 
@@ -985,17 +2661,65 @@ class RWDBPool:
         for x in dbcf.get('slave', []):
             x['name'] = dbcf.get('name', '')
             x['role'] = 's'
-            slave = DBPool(x)
+            slave = DBPool(x, warm)
+            slave.rw = self
             self.slaves.append(slave)
 
+        # table模式的读，和从库读的查询缓存都要用到表的写入时间
+        self.track_write = self.consistency == 'table' or any(
+                [x.dbcf.get('cache_tables') for x in [self.master] + self.slaves])
+
     def get_slave(self):
+        '''按策略选择从库: round_robin/least_conn/latency，跳过被摘除的从库'''
+        slaves = [x for x in self.slaves if x.is_up()] or self.slaves
         if self.policy == 'round_robin':
-            size = len(self.slaves)
+            size = len(slaves)
+            self._slave_current = (self._slave_current + 1) % size
+            return slaves[self._slave_current]
+        elif self.policy == 'least_conn':
+            # 使用中连接最少的从库，相同时轮询
+            size = len(slaves)
             self._slave_current = (self._slave_current + 1) % size
-            return self.slaves[self._slave_current]
+            slaves = slaves[self._slave_current:] + slaves[:self._slave_current]
+            return min(slaves, key=lambda x: len(x.dbconn_using))
+        elif self.policy == 'latency':
+            # 按查询耗时的倒数加权随机，慢的从库分到的读请求少
+            weights = [1.0 / (x.ewma * (len(x.dbconn_using) + 1) + 1) for x in slaves]
+            r = random.random() * sum(weights)
+            for i,w in enumerate(weights):
+                r -= w
+                if r < 0:
+                    return slaves[i]
+            return slaves[-1]
         else:
             raise ValueError('policy not support')
 
+    def mark_write(self, tables):
+        now = time.time()
+        for t in tables:
+            self._write_time[t] = now
+
+    def recent_write(self, tables):
+        '''表是否在一致性窗口内写过'''
+        if not self._write_time:
+            return False
+        now = time.time()
+        for t in tables:
+            if now - self._write_time.get(t, 0) < self.consistency_window:
+                return True
+        return False
+
+    def acquire_slave(self, timeout=10):
+        '''从从库获取连接，失败时换一个从库重试'''
+        for i in range(0, len(self.slaves)):
+            slave = self.get_slave()
+            try:
+                return slave.acquire(timeout)
+            except:
+                if i == len(self.slaves) - 1:
+                    raise
+                log.warning('func=acquire_slave|error=%s', traceback.format_exc())
+
     def get_master(self):
         return self.master
 
@@ -1012,6 +2736,20 @@ class RWDBPool:
             conn._slave.pool.release(conn._slave)
 
 
+    def maintain(self):
+        for x in [self.master] + self.slaves:
+            x.maintain()
+
+    def stats(self):
+        return {'master': self.master.stats(), 'slave': [x.stats() for x in self.slaves]}
+
+    def pools(self):
+        return [self.master] + self.slaves
+
+    @property
+    def ready(self):
+        return all([x.ready for x in self.pools()])
+
     def size(self):
         ret = {'master': (-1,-1), 'slave':[]}
         if self.master:
@@ -1038,21 +2776,134 @@ def checkalive(name=None):
             pool.alive()
         time.sleep(300)
 
-def install(cf):
+class PoolMaintainer (threading.Thread):
+    '''连接池后台维护线程，每个进程一个，将维护工作移出请求路径'''
+    def __init__(self, interval=5):
+        threading.Thread.__init__(self, name='dbpool-maintain')
+        self.daemon = True
+        self.interval = interval
+        self.pid = os.getpid()
+        self.stat = {'run':0, 'error':0, 'time':0}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        starttm = time.time()
+        for name,pool in list((dbpool or {}).items()):
+            try:
+                pool.maintain()
+            except:
+                self.stat['error'] += 1
+                log.error('func=maintain|name=%s|error=%s', name, traceback.format_exc())
+        self.stat['run'] += 1
+        self.stat['time'] = int((time.time()-starttm)*1000000)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+maintainer = None
+
+def start_maintain(interval=None):
+    '''启动后台维护线程，fork后的子进程调用时会重新启动'''
+    global maintainer
+    if interval is None:
+        interval = settings.get('maintain_interval', 5)
+    if not interval:
+        return None
+    if maintainer and maintainer.pid == os.getpid() and maintainer.is_alive():
+        return maintainer
+    maintainer = PoolMaintainer(interval)
+    maintainer.start()
+    return maintainer
+
+def _maintain_after_fork():
+    '''fork后子进程中没有父进程的线程，父进程启动过维护线程时在子进程中重新启动'''
+    if maintainer is not None:
+        start_maintain(maintainer.interval)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_maintain_after_fork)
+
+def snapshot():
+    '''所有连接池的状态和指标快照，可以json序列化'''
+    return {
+        'time': int(time.time()),
+        'pool': dict([(name, pool.stats()) for name,pool in (dbpool or {}).items()]),
+        'metrics': metrics.snapshot(),
+        'sql_cache': sql_cache.stat(),
+        'result_cache': result_cache.stat(),
+        'slow_query': dict(slow_log.stat),
+    }
+
+def maintain_stat():
+    '''返回所有连接池的维护计数'''
+    ret = {'maintainer': maintainer.stat if maintainer else None, 'pool': {}}
+    for name,pool in (dbpool or {}).items():
+        if isinstance(pool, RWDBPool):
+            ret['pool'][name] = {'master': pool.master.maint,
+                                 'slave': [x.maint for x in pool.slaves]}
+        else:
+            ret['pool'][name] = pool.maint
+    return ret
+
+def warmup(pools):
+    '''所有连接池并行预热，主库预热失败时抛出异常'''
+    errors = []
+
+    def _warm(pool):
+        try:
+            pool.warmup()
+        except Exception as e:
+            log.error('func=warmup|pool=%s|error=%s', pool.key, traceback.format_exc())
+            errors.append(e)
+
+    ths = [threading.Thread(target=_warm, args=(x,), name='dbpool-warmup') for x in pools]
+    for th in ths:
+        th.start()
+    for th in ths:
+        th.join()
+    if errors:
+        raise errors[0]
+
+def ready(name=None):
+    '''连接池是否预热完成，可以在预热完成前不接入流量'''
+    if dbpool is None:
+        return False
+    names = [name] if name else dbpool.keys()
+    return all([dbpool[x].ready for x in names])
+
+def install(cf, wait=True):
+    '''初始化连接池，wait为False时在后台预热，用ready()查询是否完成'''
     global dbpool
     if dbpool:
         log.warn("too many install db")
         return dbpool
     dbpool = {}
 
+    pools = []
     for name,item in cf.items():
         item['name']  = name
         dbp = None
         if 'master' in item:
-            dbp = RWDBPool(item)
+            dbp = RWDBPool(item, False)
+            pools.extend(dbp.pools())
         else:
-            dbp = DBPool(item)
+            dbp = DBPool(item, False)
+            pools.append(dbp)
         dbpool[name] = dbp
+
+    if wait:
+        warmup(pools)
+    else:
+        th = threading.Thread(target=warmup, args=(pools,), name='dbpool-warmup')
+        th.daemon = True
+        th.start()
+
+    start_maintain()
     return dbpool
 
 
@@ -1089,6 +2940,26 @@ def get_connection(token):
 
 get_connection_exception = get_connection
 
+# 事务: 正常退出提交，异常回滚，连接归还连接池。读写分离的库使用主库连接
+# with get_transaction('db') as tx:
+#     tx.insert(...)
+#     with tx.transaction(): # savepoint
+#         tx.update(...)
+@contextmanager
+def get_transaction(token):
+    conn = None
+    try:
+        conn = acquire(token)
+        tx = conn.master if isinstance(conn, DBConnProxy) else conn
+        with tx.transaction():
+            yield tx
+    except:
+        log.error("error=%s", traceback.format_exc())
+        raise
+    finally:
+        if conn:
+            release(conn)
+
 @contextmanager
 def get_connection_noexcept(token):
     conn = None
@@ -1102,6 +2973,74 @@ def get_connection_noexcept(token):
             release(conn)
 
 
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(settings.get('parallel_workers', 16),
+                    thread_name_prefix='dbpool-parallel')
+        return _executor
+
+def _executor_after_fork():
+    '''fork后子进程中没有父进程executor的线程，提交的任务不会执行，子进程中重新创建'''
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_executor_after_fork)
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+def _run_one(call, timeout):
+    name, sql = call[0], call[1]
+    param = call[2] if len(call) > 2 else None
+    conn = None
+    try:
+        conn = acquire(name, timeout)
+        if callable(sql):
+            return sql(conn)
+        return conn.query(sql, param)
+    except Exception as e:
+        log.warning('func=run_parallel|name=%s|error=%s', name, traceback.format_exc())
+        return e
+    finally:
+        if conn:
+            release(conn)
+
+def run_parallel(calls, timeout=10, raise_error=False):
+    '''每条语句使用单独的连接并发执行，按顺序返回结果
+    calls - [(name, sql, params), ...]，sql也可以是以连接为参数的函数: (name, func)
+    raise_error - 为False时出错语句的结果是异常对象，为True时抛出第一个异常
+    gevent环境(已patch socket)下使用协程，否则使用线程池
+    '''
+    funcs = [functools.partial(_run_one, call, timeout) for call in calls]
+    if not funcs:
+        return []
+    if _gevent_patched():
+        import gevent
+        jobs = [gevent.spawn(f) for f in funcs]
+        gevent.joinall(jobs)
+        ret = [j.value for j in jobs]
+    else:
+        # 第一条在当前线程执行
+        futs = [_get_executor().submit(f) for f in funcs[1:]]
+        ret = [funcs[0]()] + [f.result() for f in futs]
+    if raise_error:
+        for x in ret:
+            if isinstance(x, Exception):
+                raise x
+    return ret
+
 # 只能用在类方法上面，并且并不推荐使用此方法，使用get_connection更好
 def with_database(name, errfunc=None, errstr=''):
     def f(func):
@@ -1185,6 +3124,279 @@ def test(way='simple'):
         settings['log_level'] = 'all'
 
 
+def test_consistency():
+    '''主从为不同的sqlite文件，从库没有数据，读到数据说明读了主库'''
+    import tempfile
+    path = tempfile.mkdtemp()
+    def cf(mode):
+        m = {'engine':'sqlite', 'db':os.path.join(path, mode + '_m.db'), 'conn':2}
+        s = {'engine':'sqlite', 'db':os.path.join(path, mode + '_s.db'), 'conn':2}
+        return {'name':mode, 'consistency':mode, 'master':m, 'slave':[s]}
+    for mode in ('table', 'session'):
+        pool = RWDBPool(cf(mode))
+        for p in (pool.master, pool.slaves[0]):
+            c = p.acquire()
+            c.execute('create table t(id integer primary key, name text)')
+            p.release(c)
+        pool._write_time.clear() # 建表也记录了写入时间
+
+        # 只取写方法不调用不算写过
+        conn = pool.acquire()
+        conn.insert
+        assert conn.select('t') == [] and conn._slave is not None
+        pool.release(conn)
+
+        # 通过master和事务写
+        conn = pool.acquire()
+        with conn.master.transaction():
+            conn.master.insert('t', {'name':'a'})
+        assert len(conn.select('t')) == 1, mode
+        pool.release(conn)
+        if mode == 'table':
+            assert pool.recent_write(['t'])
+            conn = pool.acquire()
+            assert len(conn.select('t')) == 1
+            pool.release(conn)
+    print('consistency ok')
+
+
+def test_sql_cache():
+    conn = SQLiteConnection({'engine':'sqlite', 'db':':memory:'}, time.time(), 0)
+    conn.name = 'test'
+    # join的on字段不同，不能用同一个模板
+    a = conn.select_join_sql('t1', 't2', on={'t1.id':'t2.uid'}, where={'t1.id':1})
+    b = conn.select_join_sql('t1', 't2', on={'t1.id':'t2.pid'}, where={'t1.id':1})
+    assert '`t2`.`uid`' in a and '`t2`.`pid`' in b, (a, b)
+    # in的值为不同长度和类型的可迭代对象
+    for v,x in (([1,2], '1,2'), ((1,2,3), '1,2,3'), (set([4,5,6,7]), '4,5,6,7'),
+            (range(7, 9), '7,8'), (iter([1]), '1'), ([3], '3')):
+        sql = conn.select_sql('t', {'id':('in', v)})
+        assert sql.endswith('(`id` in (%s))' % x), sql
+    sql = conn.select_sql('t', {'id':('between', range(3, 5))})
+    assert sql.endswith('(`id` between  3 and 4)'), sql
+    print(sql_cache.stat())
+
+
+def test_result_cache():
+    import tempfile
+    path = tempfile.mkdtemp()
+    db = os.path.join(path, 'cache.db')
+    pool = DBPool({'name':'cache', 'engine':'sqlite', 'db':db, 'conn':2, 'cache_tables':['t']})
+    conn = pool.acquire()
+    try:
+        conn.execute('create table t(id integer primary key, name text)')
+        conn.insert('t', {'name':'a'})
+        # 同样的sql，select返回列表，select_one返回一行，不能共用缓存
+        assert len(conn.select('t', {'id':1})) == 1
+        assert conn.select_one('t', {'id':1})['name'] == 'a'
+        # 写表后缓存失效
+        conn.update('t', {'name':'b'}, {'id':1})
+        assert conn.select('t', {'id':1})[0]['name'] == 'b'
+        # 事务中写过的表，提交前不放入缓存
+        conn.start()
+        conn.update('t', {'name':'c'}, {'id':1})
+        assert ('cache', 't') in result_cache.pending
+        conn.commit()
+        assert ('cache', 't') not in result_cache.pending
+        assert conn.select_one('t', {'id':1})['name'] == 'c'
+        # 事务中连接关闭，pending的表也要清掉
+        conn.start()
+        conn.update('t', {'name':'d'}, {'id':1})
+        conn.close()
+        assert ('cache', 't') not in result_cache.pending
+        conn.connect()
+    finally:
+        pool.release(conn)
+
+    # 主从为不同的sqlite文件，主库写过后一致性窗口内从库的读不缓存
+    m = {'engine':'sqlite', 'db':os.path.join(path, 'm.db'), 'conn':2}
+    s = {'engine':'sqlite', 'db':os.path.join(path, 's.db'), 'conn':2}
+    pool = RWDBPool({'name':'rwcache', 'master':m, 'slave':[s], 'cache_tables':['t']})
+    for p in (pool.master, pool.slaves[0]):
+        c = p.acquire()
+        c.execute('create table t(id integer primary key, name text)')
+        p.release(c)
+    slave = pool.slaves[0].acquire()
+    master = pool.master.acquire()
+    assert slave.select('t') == []
+    master.insert('t', {'name':'a'})
+    assert pool.recent_write(['t'])
+    assert slave.select('t') == []
+    import sqlite3
+    c = sqlite3.connect(s['db']) # 模拟从库同步，不经过连接池
+    c.execute("insert into t(name) values ('a')")
+    c.commit()
+    c.close()
+    assert len(slave.select('t')) == 1
+    pool.slaves[0].release(slave)
+    pool.master.release(master)
+    print('result cache ok', result_cache.stat())
+
+
+def test_sqlite_thread_conn():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'thread.db')
+    pool = DBPool({'name':'thread', 'engine':'sqlite', 'db':path, 'conn':2, 'thread_conn':True})
+    # 同一个线程同时使用两个连接，第二个不能共用线程的连接
+    c1 = pool.acquire()
+    c2 = pool.acquire()
+    assert c1.conn is not c2.conn
+    c1.execute('create table t(id integer primary key, name text)')
+    c1.start()
+    c1.insert('t', {'name':'a'})
+    c1.rollback()
+    assert c2.select('t') == []
+    x = c1.conn
+    pool.release(c2)
+    pool.release(c1)
+    c = pool.acquire()
+    assert c.conn is x
+    pool.release(c)
+
+    # 写线程退出后提交的写入不会一直等待，再取写线程时重新创建
+    param = {'db':path, 'write_queue':True}
+    w = _sqlite_writers[path] = SQLiteWriter(param)
+    try:
+        w.submit("insert into t(name) values ('b')", None, False)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('writer not alive')
+    assert sqlite_writer(param) is not w
+    assert sqlite_writer(param).submit("insert into t(name) values ('b')", None, False)[0] == 1
+    print('sqlite thread conn ok')
+
+
+def test_cursor_page():
+    '''游标分页: 排序字段有NULL，format_time转换的时间字段，逐页取完不重复不遗漏'''
+    import tempfile
+    pool = DBPool({'name':'cursor', 'engine':'sqlite', 'db':os.path.join(tempfile.mkdtemp(), 'cursor.db'), 'conn':1})
+    conn = pool.acquire()
+    conn.execute('create table t(id integer primary key, score int, ctime int)')
+    for i in range(1, 31):
+        conn.insert('t', {'score':None if i % 4 == 0 else i % 3, 'ctime':1700000000 + i % 5})
+    old = settings.get('format_time')
+    settings['format_time'] = True
+    try:
+        for order in ('score', 'score desc', 'ctime desc, score', 'score desc, ctime, id desc'):
+            ids = []
+            cursor = None
+            while True:
+                pd = pager.PageDataDB(conn, 'select id, score, ctime from t', order=order, cursor=cursor)
+                rows = pd.load(1, 4, isdict=True)
+                assert all([isinstance(x['ctime'], datetime.datetime) for x in rows])
+                ids.extend([x['id'] for x in rows])
+                cursor = pd.next_cursor
+                if not pd.has_more:
+                    break
+            assert sorted(ids) == list(range(1, 31)), (order, ids)
+    finally:
+        settings['format_time'] = old
+        pool.release(conn)
+    for cursor in (pager.encode_cursor([1]), pager.encode_cursor([{'a':1}, 2]), 'x'):
+        try:
+            pager.decode_cursor(cursor, 2)
+        except ValueError:
+            continue
+        raise AssertionError(cursor)
+    print('cursor page ok')
+
+
+def test_bench_pool(nthread=16, count=2000, conn=8):
+    '''连接池并发压测: nthread个线程各自做count次acquire/release
+    用thread_conn保持连接打开，释放后连接对象回到连接池复用，只测连接池本身的开销
+    '''
+    pool = DBPool({'engine':'sqlite', 'db':':memory:', 'conn':conn, 'thread_conn':True})
+    connects = metrics.counter('connect', pool.key)
+
+    def run():
+        for i in range(0, count):
+            c = pool.acquire()
+            pool.release(c)
+
+    ths = [threading.Thread(target=run) for i in range(0, nthread)]
+    starttm = time.time()
+    for t in ths:
+        t.start()
+    for t in ths:
+        t.join()
+    usetm = time.time() - starttm
+
+    total = nthread * count
+    print('thread=%d|conn=%d|total=%d|time=%.3f|qps=%d|size=%s' % (
+        nthread, conn, total, usetm, total/usetm, pool.size()))
+    assert pool.size()[1] == 0
+    assert pool.nconn <= conn
+    # 连接被复用，没有每次acquire都新建
+    assert metrics.counter('connect', pool.key) - connects <= conn
+
+
+def test_bench_sqlite(nthread=8, count=500, **opts):
+    '''sqlite文件库并发读写压测，opts为sqlite配置项，如
+    test_bench_sqlite(wal=True, synchronous='NORMAL', thread_conn=True, write_queue=True)
+    '''
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    cf = {'engine':'sqlite', 'db':path, 'conn':nthread, 'busy_timeout':30}
+    cf.update(opts)
+    pool = DBPool(cf)
+    c = pool.acquire()
+    c.execute('create table if not exists bench(id integer primary key, name text, v int)')
+    pool.release(c)
+
+    errors = []
+    def run(n):
+        try:
+            for i in range(0, count):
+                c = pool.acquire()
+                try:
+                    c.insert('bench', {'name':'t%d' % n, 'v':i})
+                    c.select('bench', where={'id':i})
+                finally:
+                    pool.release(c)
+        except Exception as e:
+            errors.append(e)
+
+    ths = [threading.Thread(target=run, args=(i,)) for i in range(0, nthread)]
+    starttm = time.time()
+    for t in ths:
+        t.start()
+    for t in ths:
+        t.join()
+    usetm = time.time() - starttm
+
+    total = nthread * count
+    print('opts=%s|thread=%d|total=%d|time=%.3f|qps=%d|error=%d' % (
+        opts, nthread, total, usetm, total*2/usetm, len(errors)))
+
+
+def test_bench_convert(n=100000):
+    '''比较逐行format_timestamp和预编译行转换函数的耗时'''
+    class Cursor:
+        description = (('id',), ('name',), ('ctime',), ('utime',), ('amt',), ('memo',))
+
+    now = int(time.time())
+    rows = [(i, 'name%d' % i, now+i, now-i, i*100, None) for i in range(0, n)]
+    conn = DBConnection({}, time.time(), 0)
+    cur = Cursor()
+
+    old = settings.get('format_time')
+    settings['format_time'] = True
+    try:
+        starttm = time.time()
+        ret1 = [conn.format_timestamp(r, cur) for r in rows]
+        tm1 = time.time() - starttm
+
+        starttm = time.time()
+        conv = conn.row_converter(cur)
+        ret2 = [conv(r) for r in rows]
+        tm2 = time.time() - starttm
+    finally:
+        settings['format_time'] = old
+
+    assert ret1 == ret2
+    print('rows=%d|format_timestamp=%.3f|row_converter=%.3f|speedup=%.1f' % (n, tm1, tm2, tm1/tm2))
+
 
 def test_main():
     import logger
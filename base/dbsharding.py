@@ -28,7 +28,7 @@ CREATE TABLE logic_table (
     way varchar(16) not null default 'r' COMMENT '表拆分的方式: r(横向拆分)/c(纵向拆分)',
     policy varchar(64) not null COMMENT '横向拆分策略: hash/month/day',
     field varchar(64) default 'id' COMMENT '拆分策略的字段名，默认为id'
-    memo varchar(1024) COMMENT '扩展信息，横向拆分策略:{"count":10},纵向拆分策略{"table":["t1","t2"],["f1,f2","t1"],["f3,f4","t2"]}',
+    memo varchar(1024) COMMENT '扩展信息，横向拆分策略:hash {"count":10,"db":["db1","db2"]}/month,day {"start":"20240101"},纵向拆分策略{"table":["t1","t2"],["f1,f2","t1"],["f3,f4","t2"]}',
     ctime DATETIME not null COMMENT '添加时间',
     utime DATETIME not null COMMENT '更新时间'
 )ENGINE=InnoDB DEFAULT CHARSET=utf8 COMMENT '数据库分表';
@@ -41,6 +41,11 @@ import copy
 import json
 import re
 import traceback
+import collections
+import zlib
+import functools
+import hashlib
+import signal
 from mtools.base import pager, dbpool
 from contextlib import contextmanager
 log = logging.getLogger()
@@ -48,85 +53,405 @@ log = logging.getLogger()
 class ShardingError (Exception):
     pass
 
+MONTH_LAST_CP = re.compile(r'month_last(\d+)')
+
+def _month_add(month, n):
+    '''yyyymm格式的月份加n个月'''
+    y, m = divmod(month // 100 * 12 + month % 100 - 1 + n, 12)
+    return y * 100 + m + 1
+
+class RouteTable:
+    '''logic_db的policy编译后的路由表
+    规则按顺序匹配，第一个匹配的生效:
+    a,b,c - 表名列表，放入表名到库名的字典
+    ^...  - 正则，预先编译
+    var:prefix_month[_lastN] - 按月分表，表名为prefix_yyyymm，month_lastN为最近N个月(含当前月)
+    查询结果按表名缓存，月份变化时重新计算月份窗口并清空缓存
+    '''
+    def __init__(self, policy, maxsize=10000):
+        policy = policy or {}
+        self.maxsize = maxsize
+        self.default = policy.get('default')
+        self.valid = True
+        for k in ('db', 'rule', 'default'):
+            if not policy.get(k):
+                log.info('not found policy:%s', k)
+                self.valid = False
+                break
+
+        # 表名 => (规则序号, 库名)，同一个表名只保留第一条规则
+        self.exact = {}
+        # [(规则序号, 正则match函数, 库名)]
+        self.regex = []
+        # [(规则序号, 表名前缀, 最近月数(0为不限), 库名)]
+        self.months = []
+        for i,(r,db) in enumerate(policy.get('rule') or []):
+            if r.startswith('var:'):
+                r1 = r[4:]
+                m = MONTH_LAST_CP.search(r1)
+                if m:
+                    self.months.append((i, r1.split('_')[0], int(m.group(1)), db))
+                elif r1.find('month') >= 0:
+                    self.months.append((i, r1.split('_')[0], 0, db))
+            elif r[0] == '^':
+                self.regex.append((i, re.compile(r).match, db))
+            else:
+                for t in r.split(','):
+                    self.exact.setdefault(t, (i, db))
+        self._cache = {}
+        self._expire = 0
+        self.refresh()
+
+    def refresh(self):
+        '''计算当前的月份窗口，到下个月时失效'''
+        now = datetime.datetime.now()
+        self.month = now.year * 100 + now.month
+        # 表名前缀对应的规则: [(规则序号, 月数, 最早月份, 库名)]
+        window = {}
+        for i,prefix,n,db in self.months:
+            window.setdefault(prefix, []).append((i, n, _month_add(self.month, 1-n), db))
+        self.window = window
+        y, m = divmod(now.year * 12 + now.month, 12)
+        self._expire = time.mktime((y, m+1, 1, 0, 0, 0, 0, 0, -1))
+        self._cache = {}
+
+    def _match(self, table):
+        # 取匹配的规则中序号最小的
+        best = self.exact.get(table)
+        tx = table.split('_')
+        if len(tx) > 1 and tx[1].isdigit():
+            tv = int(tx[1])
+            for i,n,start,db in self.window.get(tx[0], ()):
+                if best and i > best[0]:
+                    break
+                if n == 0 or (tv == self.month if n == 1 else tv >= start):
+                    best = (i, db)
+                    break
+        for i,match,db in self.regex:
+            if best and i > best[0]:
+                break
+            if match(table):
+                best = (i, db)
+                break
+        return best[1] if best else self.default
+
+    def route(self, table):
+        if not self.valid:
+            return None
+        if time.time() >= self._expire:
+            self.refresh()
+        db = self._cache.get(table)
+        if db is None:
+            db = self._match(table)
+            if len(self._cache) >= self.maxsize:
+                self._cache = {}
+            self._cache[table] = db
+        return db
+
+
+# 合并多个分片结果时支持的sql尾部: group by/having/order by/limit
+TAIL_CP = re.compile(r'^\s*(?:group\s+by\s+(?P<group>.+?))?\s*(?:having\s+(?P<having>.+?))?\s*'
+        r'(?:order\s+by\s+(?P<order>.+?))?\s*(?:limit\s+(?P<limit>\d+)'
+        r'(?:\s*,\s*(?P<limit2>\d+)|\s+offset\s+(?P<offset>\d+))?)?\s*$', re.I|re.S)
+SELECT_CP = re.compile(r'^\s*select\s+(.+?)\s+from\s', re.I|re.S)
+# 逻辑表上可以在所有物理表执行的写操作
+WRITE_ALL_CP = re.compile(r'^\s*(?:update|delete)\s', re.I)
+LIMIT_CP = re.compile(r'\slimit\s+\d', re.I)
+# mysql的聚合函数，只有count/sum/min/max可以合并多个分片的结果
+AGG_FUNCS = set(['count', 'sum', 'min', 'max', 'avg', 'group_concat', 'std', 'stddev', 'stddev_pop',
+        'stddev_samp', 'variance', 'var_pop', 'var_samp', 'bit_and', 'bit_or', 'bit_xor',
+        'json_arrayagg', 'json_objectagg'])
+AGG_MERGE = ('count', 'sum', 'min', 'max')
+FUNC_CP = re.compile(r'\b(\w+)\s*\(')
+AGG_ALIAS_CP = re.compile(r'^(?:\s+as)?(?:\s+`?(\w+)`?)?\s*$', re.I)
+DISTINCT_CP = re.compile(r'\s*distinct\b', re.I)
+
+def _split_fields(fields):
+    '''按顶层的逗号拆分字段'''
+    if isinstance(fields, (list, tuple)):
+        return list(fields)
+    ret = []
+    depth = 0
+    start = 0
+    for i,c in enumerate(fields):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            ret.append(fields[start:i].strip())
+            start = i + 1
+    ret.append(fields[start:].strip())
+    return ret
+
+def _agg_field(field):
+    '''字段是聚合函数时返回(函数名, 结果的列名)，不是聚合返回None，不能合并的聚合抛出异常'''
+    text = dbpool.mask_sql(field.strip())
+    calls = [m for m in FUNC_CP.finditer(text) if m.group(1).lower() in AGG_FUNCS]
+    if not calls:
+        return None
+    m = calls[0]
+    func = m.group(1).lower()
+    if m.start() != 0:
+        raise ShardingError('not support aggregate in expression for scatter: %s' % field)
+    depth = 0
+    for i in range(m.end() - 1, len(text)):
+        if text[i] == '(':
+            depth += 1
+        elif text[i] == ')':
+            depth -= 1
+            if depth == 0:
+                break
+    alias = AGG_ALIAS_CP.match(text[i+1:])
+    if depth or not alias:
+        raise ShardingError('not support aggregate in expression for scatter: %s' % field)
+    if func == 'avg':
+        raise ShardingError('not support avg for scatter, use sum and count')
+    if func not in AGG_MERGE:
+        raise ShardingError('not support %s for scatter' % func)
+    if DISTINCT_CP.match(text, m.end()):
+        raise ShardingError('not support %s(distinct) for scatter' % func)
+    return func, alias.group(1) or field.strip()
+
+def _column(name):
+    return name.strip().split('.')[-1].strip('`')
+
+SQL_ALIAS_CP = re.compile(dbpool.SQL_ALIAS, re.I)
+# 单表delete的表，mysql 8.0.16之前不能有别名
+SQL_DELETE_CP = re.compile(r'^\s*delete\s+(?:(?:low_priority|quick|ignore)\s+)*from\s+$', re.I)
+
+def replace_table(sql, table, newname):
+    '''把sql中引用表table的位置换成newname，字符串、注释和字段名中的同名内容不变。
+    from/join和update的表没有别名时用原表名作别名，字段上的"表名."前缀仍然有效，
+    单表delete和insert/replace into的表不加别名
+    '''
+    refs = [x for x in dbpool.sql_table_refs(sql) if x[2] == table]
+    if not refs:
+        raise ShardingError('not found table %s in sql: %s' % (table, sql))
+    text = dbpool.mask_sql(sql)
+    for start,end,name,kw in reversed(refs):
+        x = '`%s`' % newname
+        if SQL_ALIAS_CP.match(text, end):
+            pass
+        elif kw in ('join', 'update') or (kw == 'from' and not SQL_DELETE_CP.match(text[:start])):
+            x += ' as `%s`' % name
+        sql = sql[:start] + x + sql[end:]
+    return sql
+
+
+class MergePlan:
+    '''多个分片结果的合并方式: 聚合字段、分组、排序和limit'''
+    def __init__(self, fields, tail):
+        '''fields - 查询的字段，tail - where之后的group by/having/order by/limit部分'''
+        m = TAIL_CP.match(tail or '')
+        if not m:
+            raise ShardingError('not support sql for scatter: %s' % tail)
+        if m.group('having'):
+            raise ShardingError('not support having for scatter')
+        self.group = [_column(x) for x in _split_fields(m.group('group'))] if m.group('group') else []
+        self.order = []
+        if m.group('order'):
+            for x in _split_fields(m.group('order')):
+                x = x.split()
+                self.order.append((_column(x[0]) if not x[0].endswith(')') else x[0],
+                    len(x) > 1 and x[1].lower() == 'desc'))
+        if m.group('limit2'):
+            self.offset, self.limit = int(m.group('limit')), int(m.group('limit2'))
+        elif m.group('limit'):
+            self.offset, self.limit = int(m.group('offset') or 0), int(m.group('limit'))
+        else:
+            self.offset, self.limit = 0, None
+
+        # 列名 => 聚合函数
+        self.aggs = {}
+        for f in _split_fields(fields):
+            a = _agg_field(f)
+            if a:
+                self.aggs[a[1]] = a[0]
+
+        # 发给每个分片的sql尾部，有分组时limit只能在合并后处理
+        x = []
+        if self.group:
+            x.append('group by ' + m.group('group'))
+        if self.order:
+            x.append('order by ' + m.group('order'))
+        if self.limit is not None and not self.aggs and not self.group:
+            x.append('limit %d' % (self.offset + self.limit))
+        self.shard_tail = ' '.join(x)
+        # 需要按字段名合并时分片用字典返回
+        self.need_dict = bool(self.aggs or self.group or self.order)
+
+    def merge(self, results, isdict=True):
+        rows = self._merge(results)
+        if not isdict and self.need_dict:
+            rows = [tuple(x.values()) for x in rows]
+        return rows
+
+    def _merge(self, results):
+        rows = []
+        for ret in results:
+            rows.extend(ret or [])
+        if not self.aggs and not self.group and not self.order:
+            return rows[self.offset:self.offset + self.limit] if self.limit is not None else rows
+        if self.aggs or self.group:
+            groups = collections.OrderedDict()
+            for row in rows:
+                key = tuple([row[k] for k in self.group])
+                cur = groups.get(key)
+                if cur is None:
+                    groups[key] = dict(row)
+                    continue
+                for k,func in self.aggs.items():
+                    a, b = cur[k], row[k]
+                    if a is None or b is None:
+                        cur[k] = b if a is None else a
+                    elif func in ('count', 'sum'):
+                        cur[k] = a + b
+                    elif func == 'min':
+                        cur[k] = min(a, b)
+                    else:
+                        cur[k] = max(a, b)
+            rows = list(groups.values())
+
+        # 多字段排序: 从最后一个字段开始做稳定排序，NULL排在最前
+        for k,desc in reversed(self.order):
+            rows.sort(key=lambda r: (r[k] is not None, r[k]), reverse=desc)
+        if self.limit is not None:
+            rows = rows[self.offset:self.offset + self.limit]
+        return rows
+
+
+def _to_date(v):
+    '''拆分字段的值转为日期: datetime/date、时间戳、或以yyyymm[dd]开头的字符串'''
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v
+    if isinstance(v, (int, float)):
+        return datetime.datetime.fromtimestamp(v)
+    x = re.sub(r'\D', '', str(v))
+    if len(x) >= 8:
+        return datetime.date(int(x[:4]), int(x[4:6]), int(x[6:8]))
+    if len(x) == 6:
+        return datetime.date(int(x[:4]), int(x[4:6]), 1)
+    raise ShardingError('date value error: %s' % v)
+
+
+class TableRule:
+    '''logic_table的横向拆分规则，由拆分字段的值得到物理表名
+    hash  - 表名_序号，序号为整数值(其他值为crc32)对count取模，memo: {"count":10, "db":["db1","db2"]}
+            db可选，第i个表放在db[i % len(db)]，不设置时按logic_db的规则路由物理表名
+    month - 表名_yyyymm，memo: {"start":"202401"}，全表操作的范围为start到当前月
+    day   - 表名_yyyymmdd，memo: {"start":"20240101"}，全表操作的范围为start到今天
+    '''
+    def __init__(self, row):
+        self.table = row['tbname']
+        self.policy = row['policy']
+        self.field = row.get('field') or 'id'
+        memo = json.loads(row['memo']) if row.get('memo') else {}
+        self.count = int(memo.get('count', 0))
+        self.dbs = memo.get('db')
+        self.start = memo.get('start')
+        if self.policy == 'hash' and self.count <= 0:
+            raise ShardingError('logic_table %s hash need count' % self.table)
+        if self.policy not in ('hash', 'month', 'day'):
+            raise ShardingError('logic_table %s policy error: %s' % (self.table, self.policy))
+        self.fmt = '%Y%m' if self.policy == 'month' else '%Y%m%d'
+
+    def suffix(self, v):
+        if self.policy == 'hash':
+            if isinstance(v, str) and not v.isdigit():
+                return str(zlib.crc32(v.encode('utf-8')) % self.count)
+            return str(int(v) % self.count)
+        return _to_date(v).strftime(self.fmt)
+
+    def physical(self, v):
+        return '%s_%s' % (self.table, self.suffix(v))
+
+    def db(self, phys):
+        '''物理表所在的库名，None表示按logic_db的规则路由'''
+        if self.policy == 'hash' and self.dbs:
+            return self.dbs[int(phys.rsplit('_', 1)[1]) % len(self.dbs)]
+        return None
+
+    def all(self, lo=None, hi=None):
+        '''所有物理表，month/day可以用lo/hi限定范围'''
+        if self.policy == 'hash':
+            return ['%s_%d' % (self.table, i) for i in range(0, self.count)]
+        today = datetime.date.today()
+        start = _to_date(self.start) if self.start else today
+        if lo is not None:
+            start = max(start, _to_date(lo))
+        end = min(_to_date(hi), today) if hi is not None else today
+        if isinstance(start, datetime.datetime):
+            start = start.date()
+        if isinstance(end, datetime.datetime):
+            end = end.date()
+        ret = []
+        if self.policy == 'day':
+            while start <= end:
+                ret.append('%s_%s' % (self.table, start.strftime(self.fmt)))
+                start += datetime.timedelta(days=1)
+        else:
+            m, last = start.year * 12 + start.month - 1, end.year * 12 + end.month - 1
+            while m <= last:
+                ret.append('%s_%d%02d' % (self.table, m // 12, m % 12 + 1))
+                m += 1
+        return ret
+
+    def split(self, where):
+        '''按where中拆分字段的条件得到涉及的物理表: [(物理表, where)]
+        等值条件为一个表，in的值按表拆分，month/day的between按范围，其他条件为所有表
+        '''
+        v = (where or {}).get(self.field)
+        if v is None:
+            return [(t, where) for t in self.all()]
+        if not isinstance(v, (tuple, list)):
+            return [(self.physical(v), where)]
+        op, val = v[0].lower(), v[1]
+        if op == '=':
+            return [(self.physical(val), where)]
+        if op == 'in':
+            groups = collections.OrderedDict()
+            for x in val:
+                groups.setdefault(self.physical(x), []).append(x)
+            return [(t, dict(where, **{self.field:('in', xs)})) for t,xs in groups.items()]
+        if op == 'between' and self.policy != 'hash':
+            return [(t, where) for t in self.all(val[0], val[1])]
+        return [(t, where) for t in self.all()]
+
+
 class ShardingConnProxy:
     def __init__(self, manager, name):
-        self._mg = manager
+        # 固定使用创建时的元数据快照，reload不影响已经创建的连接
+        self._mg = manager.snapshot
         self._name = name
-        self._info = manager._dbinfo.get(name)
+        self._info = self._mg._dbinfo.get(name)
+        # 横向拆分的逻辑表: 表名 => TableRule
+        self._tables = self._mg._tables.get(name, {})
         self._conn = {}
         self._last_conn = None
 
     def _route(self, table):
         '''根据表名返回对应的数据库名'''
-        if not self._info:
-            return None
-
-        dbs = self._info.get('db')
-        if not dbs:
-            log.info('not found policy:db')
-            return None
-
-        rule = self._info.get('rule')
-        if not rule:
-            log.info('not found policy:rule')
+        rt = self._mg._routes.get(self._name)
+        if not rt:
             return None
+        return rt.route(table)
 
-        default = self._info.get('default')
-        if not default:
-            log.info('not found policy:default')
-            return None
-
-        for r,db in rule:
-            #log.debug('%s: %s', r, db)
-            if r.startswith('var:'):
-                r1 = r[4:]
-                tx = table.split('_')
-                rx = r1.split('_')
-
-                if tx[0] != rx[0]:
-                    #log.debug('prefix not equal: %s', tx[0])
-                    continue
-
-
-                now = datetime.datetime.now()
-                month = '%d%02d' % (now.year, now.month)
-
-                tv1 = int(tx[1])
-                mv1 = int(month)
-                #log.debug('%d %d r1:%s', tv1, mv1, r1)
-                if r1.find('month_last1') >= 0:
-                    if mv1 == tv1:
-                        return db
-                elif r1.find('month_last2') >= 0:
-                    if mv1 - tv1 <= 1:
-                        return db
-                elif r1.find('month_last3') >= 0:
-                    if mv1 - tv1 <= 2:
-                        return db
-                elif r1.find('month') >= 0:
-                    return db
-
-            elif r[0] == '^' and re.match(r, table):
-                return db
-            else:
-                p = r.split(',')
-                if table in p:
-                    return db
-
-
-        return default
-
-    def _get_conn(self, tname):
-        '''根据表名返回数据库连接对象'''
+    def _get_conn(self, tname, dbnm=None):
+        '''根据表名返回数据库连接对象，dbnm为指定的库(真实数据库名)'''
         log.debug('get conn: %s', tname)
 
-        dbnm = self._route(tname)
+        if not dbnm:
+            dbnm = self._route(tname)
 
         if not dbnm: # 无数据表映射到库，所以使用默认的库
             dbnm = self._name
 
         # 真实数据库名转换到数据库配置的key名称
-        tb = self._mg._dbname.get(dbnm, dbnm)
+        return self._acquire(self._mg._dbname.get(dbnm, dbnm))
+
+    def _acquire(self, tb):
+        '''取连接池tb的连接，同一个代理中复用'''
         if tb in self._conn:
             log.debug('get conn %s in cache', tb)
             conn = self._conn[tb]
@@ -137,15 +462,77 @@ class ShardingConnProxy:
 
         return conn
 
+    def _shards(self, table, dbs=None):
+        '''scatter查询的分片: [(连接池名, 表名)]，默认为逻辑库policy中的所有库'''
+        if dbs is None:
+            dbs = (self._info or {}).get('db') or [self._name]
+        ret = []
+        for x in dbs:
+            if isinstance(x, (list, tuple)):
+                db, tb = x
+            else:
+                db, tb = x, table
+            ret.append((self._mg._dbname.get(db, db), tb))
+        return ret
+
+    def _shard_db(self, rule, phys):
+        '''物理表所在的库名'''
+        return rule.db(phys) or self._route(phys) or self._name
+
+    def _placement(self, rule, phys):
+        '''物理表所在的连接池名'''
+        dbnm = self._shard_db(rule, phys)
+        return self._mg._dbname.get(dbnm, dbnm)
+
+    def _targets(self, rule, where):
+        '''逻辑表的where拆到物理表: [(连接池名, 物理表, where)]'''
+        return [(self._placement(rule, t), t, w) for t,w in rule.split(where)]
+
+    def _scatter(self, calls):
+        '''在各分片上并发执行，每个分片使用单独的连接池连接'''
+        return dbpool.run_parallel(calls, raise_error=True)
+
+    def select_all(self, table, where=None, fields='*', other=None, isdict=True, dbs=None):
+        '''在所有分片上查询并合并结果: 按order by排序，limit在合并后生效，
+        count/sum/min/max按group by字段合并，不支持avg和having
+        dbs - 指定分片，库名列表或[(库名, 表名)]
+        '''
+        targets = [(name, tb, where) for name,tb in self._shards(table, dbs)]
+        return self._select_targets(targets, fields, other, isdict)
+
+    def _select_targets(self, targets, fields, other, isdict):
+        plan = MergePlan(fields, other)
+        def run(tb, where):
+            return lambda conn: conn.select(tb, where, fields, plan.shard_tail, isdict or plan.need_dict)
+        ret = self._scatter([(name, run(tb, where)) for name,tb,where in targets])
+        return plan.merge(ret, isdict)
+
+    def query_all(self, sql, param=None, isdict=True, dbs=None):
+        '''同一个sql在所有分片上执行并合并结果，只支持单表的简单查询，合并规则见select_all'''
+        m = SELECT_CP.match(sql)
+        if not m:
+            raise ShardingError('not support sql for scatter: %s' % sql)
+        c = pager.CLAUSE_CP.search(sql)
+        head, tail = (sql[:c.start()], sql[c.start():]) if c else (sql, '')
+        plan = MergePlan(m.group(1), tail)
+        shard_sql = head + ' ' + plan.shard_tail
+        table = self._get_table(sql)
+        def run(tb):
+            # 分片的表名不同时替换sql中引用表的位置
+            x = shard_sql if tb == table else replace_table(shard_sql, table, tb)
+            return lambda conn: conn.query(x, param, isdict or plan.need_dict)
+        ret = self._scatter([(name, run(tb)) for name,tb in self._shards(table, dbs)])
+        return plan.merge(ret, isdict)
+
     def _get_table(self, sql):
-        '''从sql语句中分析出表名，只支持简单查询'''
-        # NOTE: 仅能支持只对一个表进行简单的查询
-        p = sql.lower().split()
-        idx = p.index('from')
-        if idx < 0:
+        '''从sql语句中分析出用于路由的表名，优先为横向拆分的逻辑表，否则为第一个表'''
+        tables = dbpool.sql_tables(sql)
+        if not tables:
             raise ValueError('not found table')
-        tb = p[idx+1]
-        return tb
+        for tb in tables:
+            if tb in self._tables:
+                return tb
+        return tables[0]
 
 
     def release(self):
@@ -160,11 +547,31 @@ class ShardingConnProxy:
 
 
     def insert(self, table, values, other=None):
+        rule = self._tables.get(table)
+        if rule:
+            if rule.field not in values:
+                raise ShardingError('%s need shard field %s' % (table, rule.field))
+            table = rule.physical(values[rule.field])
+            conn = self._get_conn(table, rule.db(table))
+            return conn.insert(table, values, other)
         conn = self._get_conn(table)
         return conn.insert(table, values, other)
 
 
     def insert_list(self, table, values_list, other=None):
+        rule = self._tables.get(table)
+        if rule:
+            # 按物理表分组插入
+            groups = collections.OrderedDict()
+            for values in values_list:
+                if rule.field not in values:
+                    raise ShardingError('%s need shard field %s' % (table, rule.field))
+                groups.setdefault(rule.physical(values[rule.field]), []).append(values)
+            n = 0
+            for tb,rows in groups.items():
+                conn = self._get_conn(tb, rule.db(tb))
+                n += dbpool.affected_rows(conn.insert_list(tb, rows, other))
+            return n
         conn = self._get_conn(table)
         return conn.insert_list(table, values_list, other)
 
@@ -172,17 +579,50 @@ class ShardingConnProxy:
         if self._last_conn:
             self._last_conn.last_insert_id()
 
+    def _write_targets(self, targets, func):
+        '''在多个物理表上执行更新/删除，返回影响的总行数'''
+        if len(targets) == 1:
+            name, tb, where = targets[0]
+            conn = self._acquire(name)
+            return func(conn, tb, where)
+        def run(tb, where):
+            return lambda conn: dbpool.affected_rows(func(conn, tb, where))
+        return sum(self._scatter([(name, run(tb, where)) for name,tb,where in targets]))
+
     def update(self, table, values, where=None, other=None):
+        rule = self._tables.get(table)
+        if rule:
+            return self._write_targets(self._targets(rule, where),
+                    lambda conn, tb, w: conn.update(tb, values, w, other))
         conn = self._get_conn(table)
         return conn.update(table, values, where, other)
 
 
     def select(self, table, where=None, fields='*', other=None, isdict=True):
+        rule = self._tables.get(table)
+        if rule:
+            targets = self._targets(rule, where)
+            if len(targets) == 1:
+                name, tb, where = targets[0]
+                conn = self._acquire(name)
+                return conn.select(tb, where, fields, other, isdict)
+            return self._select_targets(targets, fields, other, isdict)
         conn = self._get_conn(table)
         return conn.select(table, where, fields, other, isdict)
 
 
     def select_one(self, table, where=None, fields='*', other=None, isdict=True):
+        rule = self._tables.get(table)
+        if rule:
+            targets = self._targets(rule, where)
+            if len(targets) == 1:
+                name, tb, where = targets[0]
+                conn = self._acquire(name)
+                return conn.select_one(tb, where, fields, other, isdict)
+            if not LIMIT_CP.search(' %s ' % (other or '')):
+                other = '%s limit 1' % (other or '')
+            ret = self._select_targets(targets, fields, other, isdict)
+            return ret[0] if ret else None
         conn = self._get_conn(table)
         return conn.select_one(table, where, fields, other, isdict)
 
@@ -197,26 +637,62 @@ class ShardingConnProxy:
         return conn.select_page(sql, pagecur, pagesize, count_sql, maxid)
 
     def delete(self, table, where, other=None):
+        rule = self._tables.get(table)
+        if rule:
+            return self._write_targets(self._targets(rule, where),
+                    lambda conn, tb, w: conn.delete(tb, w, other))
         conn = self._get_conn(table)
         return conn.delete(table, where, other)
 
     def query(self, sql, param=None, isdict=True, head=False):
         table = self._get_table(sql)
+        rule = self._tables.get(table)
+        if rule:
+            # 逻辑表的sql在所有物理表上执行
+            dbs = [(self._shard_db(rule, t), t) for t in rule.all()]
+            return self.query_all(sql, param, isdict, dbs)
         conn = self._get_conn(table)
         return conn.query(sql, param, isdict, head)
 
+    def query_iter(self, sql, param=None, isdict=True, batch=1000, as_batch=False):
+        table = self._get_table(sql)
+        if table in self._tables:
+            raise ShardingError('not support query_iter on logic table %s' % table)
+        conn = self._get_conn(table)
+        return conn.query_iter(sql, param, isdict, batch, as_batch)
+
     def get(self, sql, param=None, isdict=True):
         table = self._get_table(sql)
+        if table in self._tables:
+            x = sql.rstrip().rstrip(';')
+            if not LIMIT_CP.search(dbpool.mask_sql(x)):
+                x += ' limit 1'
+            ret = self.query(x, param, isdict)
+            return ret[0] if ret else None
         conn = self._get_conn(table)
         return conn.get(sql, param, isdict)
 
+    def _execute_all(self, rule, table, sql, param):
+        '''逻辑表上的update/delete在所有物理表上执行，返回影响的总行数'''
+        if not WRITE_ALL_CP.match(sql):
+            raise ShardingError('not support sql on logic table %s: %s' % (table, sql))
+        def run(tb):
+            x = replace_table(sql, table, tb)
+            return lambda conn: dbpool.affected_rows(conn.execute(x, param))
+        return sum(self._scatter([(self._placement(rule, t), run(t)) for t in rule.all()]))
+
     def execute(self, sql, param=None):
         table = self._get_table(sql)
+        rule = self._tables.get(table)
+        if rule:
+            return self._execute_all(rule, table, sql, param)
         conn = self._get_conn(table)
         return conn.execute(sql, param)
 
     def executemany(self, sql, param=None):
         table = self._get_table(sql)
+        if table in self._tables:
+            raise ShardingError('not support executemany on logic table %s' % table)
         conn = self._get_conn(table)
         return conn.executemany(sql, param)
 
@@ -231,36 +707,171 @@ class ShardingConnProxy:
 
 
 
+class ShardingSnapshot:
+    '''分库分表元数据的快照，创建后不再修改，reload时生成新的快照整体替换'''
+    def __init__(self, dbinfo=None, dbname=None, tables=None, version=0, digest=''):
+        # 逻辑库名 => policy
+        self._dbinfo = dbinfo or {}
+        # 真实数据库名 => 连接池名
+        self._dbname = dbname or {}
+        # 逻辑库名 => 编译后的路由表
+        self._routes = dict([(k, RouteTable(v)) for k,v in self._dbinfo.items()])
+        # 逻辑库名 => {逻辑表名: TableRule}
+        self._tables = tables or {}
+        self.version = version
+        self.digest = digest
+        self.ctime = time.time()
+        # 生成快照的耗时，微秒
+        self.cost = 0
+
+
 class ShardingManager:
     def __init__(self):
-        self._dbinfo = {}
-        self._dbname = {}
+        self.snapshot = ShardingSnapshot()
+        self.reload_stat = {'reload':0, 'change':0, 'error':0, 'last_time':0, 'last_error':''}
+        # 只用于reload之间互斥，读取快照不加锁
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._thread = None
+        self._stopped = False
 
         #self.load()
 
+    # 兼容直接访问管理器上的元数据
+    @property
+    def _dbinfo(self):
+        return self.snapshot._dbinfo
+
+    @property
+    def _dbname(self):
+        return self.snapshot._dbname
+
+    @property
+    def _routes(self):
+        return self.snapshot._routes
+
+    @property
+    def _tables(self):
+        return self.snapshot._tables
+
     def load(self):
-        if self._dbname:
+        if self.snapshot.version:
             return
+        self.reload()
 
+    def _read(self):
+        '''读取dbmeta中的logic_db/logic_table和当前的连接池配置'''
         with dbpool.get_connection('dbmeta') as conn:
-            ret = conn.select('logic_db')
-            if ret:
-                for row in ret:
-                    log.debug(row['policy'])
-                    self._dbinfo[row['name']] = json.loads(row['policy'])
-
+            dbs = conn.select('logic_db') or []
+            tables = conn.select('logic_table', where={'way':'r'}) or []
+        dbs = sorted([(row['name'], row['policy']) for row in dbs])
+        tables = sorted([(row['dbname'], row['tbname'], row['policy'], row.get('field'), row.get('memo'))
+                for row in tables])
         # 真实数据库名和该库的配置KEY的映射
-        for name,pool in dbpool.dbpool.items():
-            log.debug('%s => %s', pool.dbcf['db'], name)
-            self._dbname[pool.dbcf['db']] = name
+        pools = sorted([(pool.dbcf['db'], name) for name,pool in dbpool.dbpool.items()])
+        return dbs, tables, pools
+
+    def _build(self, dbs, tables, pools, version, digest):
+        dbinfo = {}
+        for name,policy in dbs:
+            log.debug(policy)
+            dbinfo[name] = json.loads(policy)
+        rules = {}
+        for dbname,tbname,policy,field,memo in tables:
+            row = {'tbname':tbname, 'policy':policy, 'field':field, 'memo':memo}
+            rules.setdefault(dbname, {})[tbname] = TableRule(row)
+        dbname = {}
+        for db,name in pools:
+            log.debug('%s => %s', db, name)
+            dbname[db] = name
+        return ShardingSnapshot(dbinfo, dbname, rules, version, digest)
+
+    def reload(self, force=False):
+        '''重新读取元数据，有变化(或force)时生成新快照并替换，返回是否替换
+        第一次加载失败抛出异常，之后失败时记录错误并继续使用旧快照
+        '''
+        with self._lock:
+            starttm = time.time()
+            old = self.snapshot
+            self.reload_stat['reload'] += 1
+            self.reload_stat['last_time'] = int(starttm)
+            try:
+                meta = self._read()
+                digest = hashlib.md5(json.dumps(meta, default=str).encode('utf-8')).hexdigest()
+                if digest == old.digest and not force:
+                    return False
+                snap = self._build(*meta, version=old.version+1, digest=digest)
+            except Exception as e:
+                self.reload_stat['error'] += 1
+                self.reload_stat['last_error'] = str(e)
+                log.error('func=sharding_reload|version=%d|error=%s', old.version, traceback.format_exc())
+                if not old.version:
+                    raise
+                return False
+            snap.cost = int((time.time()-starttm)*1000000)
+            # 引用赋值是原子的，之后创建的连接使用新快照
+            self.snapshot = snap
+            self.reload_stat['change'] += 1
+            dbpool.metrics.observe('sharding_reload', 'dbmeta', snap.cost)
+            log.info('func=sharding_reload|version=%d|digest=%s|db=%d|table=%d|time=%d',
+                    snap.version, digest, len(snap._dbinfo), sum(map(len, snap._tables.values())), snap.cost)
+            return True
+
+    def _reload_loop(self, interval):
+        while True:
+            self._event.wait(interval or None)
+            self._event.clear()
+            if self._stopped:
+                break
+            try:
+                self.reload()
+            except:
+                log.error('func=sharding_reload|error=%s', traceback.format_exc())
+
+    def start_reload(self, interval=60, sig=None):
+        '''启动后台reload线程，每interval秒检查一次，为0时只在收到信号sig(如signal.SIGHUP)时reload
+        信号处理只能在主线程设置，处理函数只唤醒reload线程
+        '''
+        if sig is not None:
+            signal.signal(sig, lambda signum, frame: self._event.set())
+        if self._thread and self._thread.pid == os.getpid() and self._thread.is_alive():
+            return self._thread
+        self._stopped = False
+        self._thread = threading.Thread(target=self._reload_loop, args=(interval,), name='sharding-reload')
+        self._thread.daemon = True
+        self._thread.pid = os.getpid()
+        self._thread.start()
+        return self._thread
+
+    def stop_reload(self):
+        self._stopped = True
+        self._event.set()
+
+    def stats(self):
+        snap = self.snapshot
+        ret = {'version':snap.version, 'digest':snap.digest, 'ctime':int(snap.ctime), 'cost':snap.cost,
+               'db':len(snap._dbinfo), 'table':sum(map(len, snap._tables.values()))}
+        ret.update(self.reload_stat)
+        return ret
 
 
 sharding = None
 
-def install():
+def install(reload_interval=0, reload_signal=None):
+    '''reload_interval - 定时重新加载元数据的间隔秒数，0为不定时加载
+    reload_signal - 触发重新加载的信号，如signal.SIGHUP
+    '''
     global sharding
     sharding = ShardingManager()
     sharding.load()
+    if reload_interval or reload_signal is not None:
+        sharding.start_reload(reload_interval, reload_signal)
+
+def reload(force=False):
+    return sharding.reload(force)
+
+def stats():
+    return sharding.stats() if sharding else {}
 
 
 @contextmanager
@@ -417,6 +1028,62 @@ def test():
     time.sleep(10)
 
 
+def test_sql_tables():
+    cases = [
+        ('select * from user where id=1', ('user',)),
+        ('SELECT a.x FROM `db`.`User` a left join orders as b on a.id=b.uid', ('user', 'orders')),
+        ('select * from a, b as bb, c where a.id=b.id', ('a', 'b', 'c')),
+        ('select * from (select id from t1 where x="from zz") x join t2 on 1', ('t1', 't2')),
+        ('insert into t3(a,b) values(1,2) on duplicate key update b=3', ('t3',)),
+        ('update t5 set a=1 where id in (select id from t6)', ('t5', 't6')),
+        ("delete from t7 where a='x from y'", ('t7',)),
+        ('select * from t8 where id=1 for update', ('t8',)),
+        ('select extract(year from ctime) y, trim(both \'x\' from name) from t9', ('t9',)),
+        ('select substring(a from 1) from t10 where id in (select max(id) from t11)', ('t10', 't11')),
+        ('select * from t12 where exists (select 1 from t13 where year(ctime)=2020)', ('t12', 't13')),
+        ('select count(*) from (select cast(x as char) from t14) a', ('t14',)),
+    ]
+    for sql, tables in cases:
+        assert dbpool.sql_tables(sql) == tables, (sql, dbpool.sql_tables(sql))
+
+    cases = [
+        ('select t.a from t where t.id=1', 'select t.a from `t_3` as `t` where t.id=1'),
+        ('select x.a from t x join u on x.id=u.id', 'select x.a from `t_3` x join u on x.id=u.id'),
+        ('select u.a from u left join t on t.id=u.id', 'select u.a from u left join `t_3` as `t` on t.id=u.id'),
+        ("select * from t where a='from t'", "select * from `t_3` as `t` where a='from t'"),
+        ('update t set t.a=1 where t.id=2', 'update `t_3` as `t` set t.a=1 where t.id=2'),
+        ('update t x set x.a=1', 'update `t_3` x set x.a=1'),
+        ('delete from t where id=2', 'delete from `t_3` where id=2'),
+        ('delete from t where id in (select id from t)',
+            'delete from `t_3` where id in (select id from `t_3` as `t`)'),
+        ('insert into t(a) values(1)', 'insert into `t_3`(a) values(1)'),
+    ]
+    for sql, ret in cases:
+        assert replace_table(sql, 't', 't_3') == ret, (sql, replace_table(sql, 't', 't_3'))
+    print(dbpool.sql_tables.cache_info())
+
+
+def test_merge_plan():
+    plan = MergePlan('uid, count(*) as n, sum(x) s, min(`y`), max(z)', 'group by uid order by n desc limit 2')
+    assert plan.aggs == {'n':'count', 's':'sum', 'min(`y`)':'min', 'max(z)':'max'}, plan.aggs
+    rows = plan.merge([
+        [{'uid':1, 'n':2, 's':3, 'min(`y`)':1, 'max(z)':5}, {'uid':2, 'n':1, 's':1, 'min(`y`)':2, 'max(z)':2}],
+        [{'uid':1, 'n':1, 's':None, 'min(`y`)':0, 'max(z)':9}, {'uid':3, 'n':5, 's':2, 'min(`y`)':3, 'max(z)':3}],
+    ])
+    assert rows == [{'uid':3, 'n':5, 's':2, 'min(`y`)':3, 'max(z)':3},
+            {'uid':1, 'n':3, 's':3, 'min(`y`)':0, 'max(z)':9}], rows
+    assert MergePlan('date(ctime) d, id', 'order by id limit 1, 2').aggs == {}
+
+    for fields in ('count(distinct uid)', 'sum( DISTINCT x) as s', 'avg(x)', 'group_concat(name)',
+            'std(x)', 'sum(a)/count(*) as r', 'max(a)+1', 'round(sum(x), 2)'):
+        try:
+            MergePlan(fields, '')
+        except ShardingError:
+            continue
+        raise AssertionError(fields)
+    print('merge plan ok')
+
+
 def test_main():
     import logger
     logger.install('stdout')
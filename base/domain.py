@@ -9,7 +9,7 @@ from mtools.base import logger
 from mtools.web.cache import Cache
 from mtools.server.rpc import ReqProto
 from mtools.server.rpcclient import Client
-from mtools.base.dbpool import get_connection
+from mtools.base.dbpool import get_connection, BulkInsertError
 
 from mtools.resp.excepts import ParamError, DBError, DevplatException
 
@@ -150,11 +150,22 @@ class Domain(object):
                 raise ParamError('写入数据失败')
         return last_id
 
-    def creates(self, datas):
+    def _bulk_error(self, e):
+        '''批量写入某一批失败，返回带失败批次信息的ParamError'''
+        log.warn(traceback.format_exc())
+        data = {'chunk': e.chunk, 'offset': e.offset, 'rows': e.rows, 'affected': e.affected}
+        if isinstance(e.cause, pymysql.err.IntegrityError) and e.cause.args[0] == 1062:
+            return ParamError('插入的数据已经存在', data=data)
+        return ParamError('写入数据失败', data=data)
+
+    def creates(self, datas, parallel=1):
+        '''批量写入，返回写入的行数'''
 
         try:
             with get_connection(self.dbname) as db:
-                db.insert_list(self.table, values_list=datas)
+                return db.insert_list(self.table, values_list=datas, parallel=parallel)
+        except BulkInsertError as e:
+            raise self._bulk_error(e)
         except pymysql.err.IntegrityError as e:
             if e.args[0] == 1062:
                 raise ParamError('插入的数据已经存在')
@@ -164,8 +175,8 @@ class Domain(object):
         except Exception:
                 raise ParamError('写入数据失败')
 
-    def create_dups(self, duplicate_key: list=None, values_list: list=None, **kw):
-        '''因唯一键有重复的数据默认update duplicate key'''
+    def create_dups(self, duplicate_key: list=None, values_list: list=None, parallel=1, **kw):
+        '''因唯一键有重复的数据默认update duplicate key，返回影响的行数'''
 
         duplicate = ','.join([f'{i}=values({i})' for i in duplicate_key or []])
         other = 'on duplicate key update utime=now()'
@@ -174,11 +185,14 @@ class Domain(object):
 
         try:
             with get_connection(self.dbname) as db:
-                db.insert_list(
+                return db.insert_list(
                     table = self.table,
                     values_list = values_list,
-                    other=other
+                    other=other,
+                    parallel=parallel
                 )
+        except BulkInsertError as e:
+            raise self._bulk_error(e)
         except pymysql.err.IntegrityError as e:
             if e.args[0] == 1062:
                 raise ParamError('插入的数据已经存在')
@@ -3,9 +3,187 @@ import sys, os
 import copy, traceback
 import math
 import logging
+import re
+import json
+import base64
+import time
+import threading
+import collections
 
 log = logging.getLogger()
 
+CLAUSE_CP = re.compile(r'\s(group\s+by|having|order\s+by|limit)\s', re.I)
+GROUP_CP = re.compile(r'\sgroup\s+by\s', re.I)
+WHERE_CP = re.compile(r'\swhere\s', re.I)
+ORDER_CP = re.compile(r'\sorder\s+by\s', re.I)
+
+def add_where(sql, cond):
+    '''在sql的where中加上条件cond，原有条件加括号。只处理没有子查询的简单sql'''
+    m = CLAUSE_CP.search(sql)
+    pos = m.start() if m else len(sql)
+    head, tail = sql[:pos], sql[pos:]
+    w = WHERE_CP.search(head)
+    if w:
+        head = '%s where (%s) and %s' % (head[:w.start()], head[w.end():].strip(), cond)
+    else:
+        head = '%s where %s' % (head.rstrip(), cond)
+    return head + tail
+
+def parse_order(order):
+    '''排序 "ctime desc,id" 或 [('ctime','desc'), 'id'] 转为 [(字段, 是否倒序), ...]'''
+    if isinstance(order, str):
+        order = [x.split() for x in order.split(',') if x.strip()]
+    ret = []
+    for x in order:
+        if isinstance(x, str):
+            x = [x]
+        ret.append((x[0], len(x) > 1 and x[1].lower() == 'desc'))
+    return ret
+
+def unique_order(order, key='id'):
+    '''排序字段有相同值时游标会跳过分页边界上的行，排序中没有主键key时加在最后，方向同最后一个字段'''
+    if not key or key in [f.split('.')[-1].strip('`') for f,desc in order]:
+        return order
+    return order + [(key, order[-1][1] if order else False)]
+
+def order_sql(order):
+    return 'order by ' + ','.join([f + (' desc' if desc else '') for f,desc in order])
+
+def encode_cursor(values):
+    '''最后一行的排序字段值编码为不透明的游标'''
+    s = json.dumps(values, default=str, separators=(',',':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, size=None):
+    '''解码游标，size为排序字段数，格式错误抛出ValueError'''
+    if not cursor:
+        return None
+    try:
+        s = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        values = json.loads(s.decode('utf-8'))
+    except Exception:
+        raise ValueError('cursor error: %s' % cursor)
+    if not isinstance(values, list) or (size is not None and len(values) != size):
+        raise ValueError('cursor error: %s' % cursor)
+    for v in values:
+        if v is not None and not isinstance(v, (str, int, float)):
+            raise ValueError('cursor error: %s' % cursor)
+    return values
+
+def _cursor_value(v):
+    # format_time转换的datetime还原为整数时间戳，和数据库中的值比较
+    if getattr(v, 'from_timestamp', False) is True:
+        return int(v.timestamp())
+    return v
+
+def row_cursor(row, order):
+    '''由一行数据生成指向该行之后的游标'''
+    return encode_cursor([_cursor_value(row[f.split('.')[-1].strip('`')]) for f,desc in order])
+
+def seek_sql(db, order, values):
+    '''游标之后的行的条件，多字段排序展开为
+    (a>va) or (a=va and b>vb) or ...，倒序字段用<。
+    NULL按mysql/sqlite的规则排在最小: 正序时在最前，倒序时在最后
+    '''
+    if len(values) != len(order):
+        raise ValueError('cursor not match order')
+    items = []
+    for i,(field, desc) in enumerate(order):
+        v = values[i]
+        if v is None:
+            # NULL之后: 正序为所有非NULL的值，倒序时没有
+            after = None if desc else '%s is not null' % field
+        elif desc:
+            after = '(%s<%s or %s is null)' % (field, db.value2sql(v), field)
+        else:
+            after = '%s>%s' % (field, db.value2sql(v))
+        if after:
+            conds = [('%s is null' % order[j][0]) if values[j] is None else
+                    ('%s=%s' % (order[j][0], db.value2sql(values[j]))) for j in range(i)]
+            conds.append(after)
+            items.append('(%s)' % ' and '.join(conds))
+    if not items:
+        return '(1=0)'
+    return '(%s)' % ' or '.join(items)
+
+class CountCache:
+    '''总数缓存: key => (过期时间, 总数, 是否估算)，超过maxsize淘汰最久未用的'''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            v = self._data.get(key)
+            if v is None or v[0] < time.time():
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return v[1], v[2]
+
+    def put(self, key, count, estimated, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, count, estimated)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stat(self):
+        return {'size':len(self._data), 'hits':self.hits, 'misses':self.misses}
+
+count_cache = CountCache()
+
+def explain_rows(db, sql):
+    '''explain估算的扫描行数，不支持时返回None'''
+    try:
+        rows = db.query('explain ' + sql)
+    except Exception:
+        log.warning('func=explain_rows|sql=%s|error=%s', sql, traceback.format_exc())
+        return None
+    n = None
+    for row in rows or []:
+        if row.get('rows') is not None:
+            n = max(n or 0, int(row['rows']))
+    return n
+
+def count_total(db, sql, mode='exact', ttl=60, estimate=100000, key=None):
+    '''执行统计总数的sql，返回(总数, 是否估算)
+    mode - exact: 每次精确统计
+           cache: 按key缓存ttl秒，key默认为(连接名, sql)
+           estimate: 同cache，explain估算的行数不小于estimate时直接用估算值
+    '''
+    if mode != 'exact':
+        if key is None:
+            key = (getattr(db, 'name', ''), sql)
+        v = count_cache.get(key)
+        if v is not None:
+            return v
+
+    n = None
+    estimated = False
+    if mode == 'estimate':
+        n = explain_rows(db, sql)
+        if n is not None and n >= estimate:
+            estimated = True
+        else:
+            n = None
+    if n is None:
+        row = db.query(sql)[0]
+        n = int(row['count'] if 'count' in row else list(row.values())[0])
+
+    if mode != 'exact':
+        count_cache.put(key, n, estimated, ttl)
+    return n, estimated
+
+
 class Pager:
     '''分页类'''
     def __init__(self, data, page, pagesize=20):
@@ -67,6 +245,8 @@ class Pager:
 
     def have_next(self):
         '''是否有后页'''
+        if getattr(self.pagedata, 'has_more', None) is not None:
+            return self.pagedata.has_more
         if self.pages > 0 and self.page >= self.pages:
             return False
         return True
@@ -101,6 +281,12 @@ class Pager:
              'page':  self.page,
              'count': self.count,
              'range': self.range}
+        if getattr(self.pagedata, 'order', None):
+            r['cursor'] = self.pagedata.next_cursor
+        if getattr(self.pagedata, 'has_more', None) is not None:
+            r['has_more'] = self.pagedata.has_more
+        if getattr(self.pagedata, 'estimated', False):
+            r['estimated'] = True
 
         return r
 
@@ -115,28 +301,53 @@ class PageDataBase:
         pass
 
 class PageDataDB (PageDataBase):
-    def __init__(self, db, sql, count_sql=None, maxid=-1):
+    def __init__(self, db, sql, count_sql=None, maxid=-1, order=None, cursor=None,
+            count_mode='exact', count_ttl=60, count_estimate=100000, order_key='id'):
         '''设置初始值
         db  - 数据库连接对象
         sql - 分页查询sql
         pagesize - 每页显示条数
         maxid - 最大id
+        order - 游标分页的排序，如 "ctime desc,id desc"，设置后按游标分页，不用limit offset
+        cursor - 游标分页时上一页返回的游标，第一页为空
+        order_key - 游标分页时保证排序唯一的主键，order中没有时加在最后，查询结果中要有该字段。
+                    sql有group by时不加
+        count_mode - 总数统计方式: exact/cache/estimate，见count_total。
+                     has_more为不统计总数，多取一行判断是否有下一页
         '''
         self.db   = db
         self.data = []
         self.url  = ''
         self.maxid = maxid
+        self.order = parse_order(order) if order else None
+        if self.order and not GROUP_CP.search(sql):
+            self.order = unique_order(self.order, order_key)
+        self.cursor = cursor
+        self.next_cursor = None
+        self.has_more = None
+        self.count_mode = count_mode
+        self.count_ttl = count_ttl
+        self.count_estimate = count_estimate
+        self.estimated = False
+
+        if self.order:
+            # 排序由order生成
+            m = ORDER_CP.search(sql)
+            self.sql = sql[:m.start()] if m else sql
 
         sql = sql.replace('%', '%%')
-        # 如果设置了最大id，在查询的时候要加上限制，但是这里有问题。可能原来的分页sql已经有where了
-        if maxid > 0:
-            self.query_sql = sql + " where id>" + str(maxid) + " limit %d"
+        # 如果设置了最大id，在查询的时候要加上限制
+        if maxid >= 0:
+            self.query_sql = add_where(sql, 'id>%d' % int(maxid)) + " limit %d"
         else:
             self.query_sql = sql + " limit %d,%d"
 
         # 生成计算所有记录的sql
         if count_sql:
             self.count_sql = count_sql
+        elif self.order or count_mode == 'has_more':
+            # 游标分页默认不统计总数
+            self.count_sql = None
         else:
             backsql  = sql[sql.find(" from "):]
             orderpos = backsql.find(' order by ')
@@ -150,21 +361,47 @@ class PageDataDB (PageDataBase):
         '''加载数据'''
         if self.data:
             return self.data
+        if self.order:
+            return self.load_cursor(pagesize, isdict)
+        # has_more模式多取一行
+        size = pagesize + 1 if self.count_mode == 'has_more' else pagesize
         if self.maxid >= 0:
-            sql = self.query_sql % (pagesize)
+            sql = self.query_sql % (size)
         else:
-            sql = self.query_sql % ((cur-1)*pagesize, pagesize)
+            sql = self.query_sql % ((cur-1)*pagesize, size)
         log.debug('PageDataDB load sql:%s', sql)
         self.data = self.db.query(sql, isdict=isdict)
+        if size > pagesize:
+            self.has_more = len(self.data) > pagesize
+            self.data = self.data[:pagesize]
+        return self.data
+
+    def load_cursor(self, pagesize, isdict=False):
+        '''按游标加载，多取一行判断是否还有下一页'''
+        sql = self.sql
+        values = decode_cursor(self.cursor, len(self.order))
+        if values:
+            sql = add_where(sql, seek_sql(self.db, self.order, values))
+        sql += ' %s limit %d' % (order_sql(self.order), pagesize + 1)
+        log.debug('PageDataDB load sql:%s', sql)
+        rows = self.db.query(sql, isdict=True) or []
+        self.has_more = len(rows) > pagesize
+        rows = list(rows[:pagesize])
+        if self.has_more:
+            self.next_cursor = row_cursor(rows[-1], self.order)
+        if not isdict:
+            rows = [list(x.values()) for x in rows]
+        self.data = rows
         return self.data
 
     def count(self, pagesize):
         '''统计页数'''
         # 没有统计页数的sql，说明不需要计算总共多少页
         #log.info("PageDataDB count sql:%s", self.count_sql)
-        ret = self.db.query(self.count_sql)
-        row = ret[0]
-        self.records = int(row['count'])
+        if not self.count_sql:
+            return -1, 0
+        self.records, self.estimated = count_total(self.db, self.count_sql,
+                self.count_mode, self.count_ttl, self.count_estimate)
         log.debug("PageDataDB count:%s", self.records)
         a = divmod(self.records, pagesize)
         if a[1] > 0:
@@ -174,9 +411,10 @@ class PageDataDB (PageDataBase):
         return self.records, page_count
 
 
-def db_pager(db, sql, pagecur, pagesize, count_sql=None, maxid=-1):
+def db_pager(db, sql, pagecur, pagesize, count_sql=None, maxid=-1, order=None, cursor=None, **kw):
+    '''kw为PageDataDB的count_mode/count_ttl/count_estimate'''
     #log.debug('sql:%s pagecur:%d pagesize:%d', sql, pagecur, pagesize)
-    pgdata = PageDataDB(db, sql, count_sql, maxid)
+    pgdata = PageDataDB(db, sql, count_sql, maxid, order, cursor, **kw)
     p = Pager(pgdata, pagecur, pagesize)
     p.split()
     return p